@@ -18,11 +18,15 @@
 # You should have received a copy of the GNU General Public License
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
+import hashlib
 import json
+import re
 import string
+import time
 import urllib
 
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 DOCUMENTATION = '''
 ---
@@ -32,18 +36,52 @@ author: Chavez
 short_description: Interact with Consul ACL API
 description:
    - Use Consul ACL API in your playbooks and roles
+   - reconcile converges a list of ACLs by name. The ACLs are listed once
+     and only the ones missing, differing or absent are created, updated
+     or destroyed, concurrently.
+   - Rules are compared by the hash of their normalized form, so HCL and
+     JSON rules that only differ in formatting, ordering or syntax match.
+     update is skipped when the ACL already has the same name, type and
+     rules.
+   - replication with wait_for_replication waits on every secondary
+     datacenter at once, with blocking queries on its ACLs, until its
+     ReplicatedIndex reaches the index of the ACLs in dc and reports the lag
+     of each datacenter.
 options:
+  acls:
+    description:
+      - ACLs to reconcile, each with a name and optionally type (default
+        client), rules and state [present, absent] (default present)
+    required: false
   acl_type:
     description:
       - Type of ACL
     required: false
   action:
     description:
-      - One of [create]
+      - One of [create, update, list, replication, info, destroy, clone,
+        reconcile]
     required: true
+  concurrency:
+    description:
+      - Number of ACLs written at once on reconcile, or datacenters waited
+        on at once for replication
+    required: false
+    default: 8
+  consistency:
+    description:
+      - Consistency mode for reads [default, stale, consistent]. stale lets
+        any server answer the read instead of the leader.
+    required: false
+    default: default
+  datacenters:
+    description:
+      - Secondary datacenters to wait on for replication, every other known
+        datacenter by default
+    required: false
   dc:
     desription:
-      - The datacenter to use
+      - The datacenter to use, the primary when waiting for replication
     required: false
     default: dc1
   host:
@@ -51,6 +89,16 @@ options:
       - Consul host
     required: true
     default: 127.0.0.1
+  index:
+    description:
+      - ACL index of the primary datacenter to wait for replication of, the
+        current index by default
+    required: false
+  max_stale:
+    description:
+      - With stale consistency, fail when the answering server last heard
+        from the leader longer ago than this duration, ie 5s
+    required: false
   name:
     description:
       - Name of event to fire
@@ -63,6 +111,11 @@ options:
     description:
       - ACL rules to set or update
     required: false
+  timeout:
+    description:
+      - Seconds to wait for replication before failing
+    required: false
+    default: 300
   token:
     description:
       - ACL token to use with requests
@@ -72,6 +125,18 @@ options:
       - Consul API version
     required: true
     default: v1
+  wait:
+    description:
+      - Max duration of each blocking query while waiting for replication,
+        ie 10s
+    required: false
+    default: 10s
+  wait_for_replication:
+    description:
+      - On replication, wait until the secondary datacenters replicated the
+        ACLs of dc
+    required: false
+    default: False
 
 # informational: requirements for nodes
 requirements: [ ]
@@ -93,6 +158,13 @@ EXAMPLES = '''
     action: replication
     token: "master-token"
 
+- name: Wait for the secondary datacenters to replicate ACL changes
+  consul_acl:
+    action: replication
+    wait_for_replication: True
+    timeout: 120
+    token: "master-token"
+
 - name: Get ACL info
   consul_acl:
     action: info
@@ -110,6 +182,18 @@ EXAMPLES = '''
     action: clone
     acl_id: "asdf-1234-asdf-1234"
     token: "master-token"
+
+- name: Reconcile ACLs
+  consul_acl:
+    action: reconcile
+    token: "master-token"
+    acls:
+      - name: web
+        rules: 'key "web/" { policy = "write" }'
+      - name: deploy
+        type: management
+      - name: legacy
+        state: absent
 '''
 
 #
@@ -119,31 +203,54 @@ EXAMPLES = '''
 
 class ConsulACL(object):
 
-    ALLOWED_ACTIONS = ['create', 'update', 'list', 'replication', 'info', 'destroy', 'clone']
-    CREATE, UPDATE, LIST, REPLICATION, INFO, DESTROY, CLONE = ALLOWED_ACTIONS
+    ALLOWED_ACTIONS = ['create', 'update', 'list', 'replication', 'info', 'destroy', 'clone', 'reconcile']
+    CREATE, UPDATE, LIST, REPLICATION, INFO, DESTROY, CLONE, RECONCILE = ALLOWED_ACTIONS
 
     PUT_ACTIONS = [CREATE, UPDATE, DESTROY, CLONE]
     GET_ACTIONS = [LIST, REPLICATION, INFO]
     ID_PATH_ACTIONS = [INFO, DESTROY, CLONE]
 
+    CONSISTENCY_MODES = ['default', 'stale', 'consistent']
+    DEFAULT, STALE, CONSISTENT = CONSISTENCY_MODES
+
+    ACL_STATES = ['present', 'absent']
+    PRESENT, ABSENT = ACL_STATES
+
+    HCL_TOKENS = re.compile(r'\s+|#[^\n]*|//[^\n]*|/\*.*?\*/|("(?:[^"\\]|\\.)*")|([{}\[\]=,:])|([^\s{}\[\]=,:"#/]+)', re.S)
+
     def __init__(self, module):
         """Takes an AnsibleModule object to set up Consul Event interaction"""
         self.module = module
         self.acl_id = module.params.get('acl_id', None)
+        self.acls = module.params.get('acls', None) or []
         self.action = string.lower(module.params.get('action', ''))
+        self.concurrency = module.params.get('concurrency', 8)
+        self.consistency = module.params.get('consistency', self.DEFAULT)
+        self.datacenters = module.params.get('datacenters', None) or []
         self.dc = module.params.get('dc', 'dc1')
         self.host = module.params.get('host', '127.0.0.1')
+        self.index = module.params.get('index', None)
         self.port = module.params.get('port', 8500)
+        self.max_stale = module.params.get('max_stale', None)
         self.version = module.params.get('version', 'v1')
         self.name = module.params.get('name', '')
         self.rules = module.params.get('rules', '')
         self.token = module.params.get('token', '')
         self.acl_type = module.params.get('acl_type', 'client')
+        self.timeout = module.params.get('timeout', 300)
+        self.wait = module.params.get('wait', '10s')
+        self.wait_for_replication = module.params.get('wait_for_replication', False)
         self.params = OrderedDict({})
         self.req_data = ''
         self._build_url()
 
     def run_cmd(self):
+        if self.action == self.RECONCILE:
+            return self._reconcile()
+        if self.action == self.UPDATE:
+            self._exit_if_unchanged()
+        if self.action == self.REPLICATION and self.wait_for_replication:
+            return self._wait_for_replication()
         self._make_api_call()
 
     def validate(self):
@@ -172,6 +279,19 @@ class ConsulACL(object):
         if not self.acl_id:
             self.module.fail_json(msg='An ACL ID is required when getting info for ACL')
 
+    def _validate_reconcile(self):
+        if not self.acls:
+            self.module.fail_json(msg='A list of acls is required to reconcile')
+        names = set()
+        for acl in self.acls:
+            if not isinstance(acl, dict) or not acl.get('name'):
+                self.module.fail_json(msg='Every ACL to reconcile needs a name: %s' % acl)
+            if acl.get('state', self.PRESENT) not in self.ACL_STATES:
+                self.module.fail_json(msg='ACL %s state must be one of %r' % (acl['name'], self.ACL_STATES))
+            if acl['name'] in names:
+                self.module.fail_json(msg='ACL %s is listed more than once' % acl['name'])
+            names.add(acl['name'])
+
     def _make_api_call(self):
         self._setup_request()
 
@@ -179,6 +299,7 @@ class ConsulACL(object):
             (response, info) = fetch_url(module, self.api_url, data=self.req_data, method=self._http_verb_for_action())
         except Exception, e:
             self.module.fail_json(msg="API call ({}) failed: {}".format(self.api_url, str(e)))
+        self.info = info
 
         try:
             response_body = response.read()
@@ -204,8 +325,42 @@ class ConsulACL(object):
             params['dc'] = self.dc
         if self.token:
             params['token'] = self.token
+        if self.action in self.GET_ACTIONS:
+            self._consistency_params(params)
+        return params
+
+    def _duration_seconds(self, duration):
+        """Converts a Consul duration like 500ms, 30s or 1m30s to seconds,
+        a bare number is taken as seconds"""
+        units = {'ns': 1e-9, 'us': 1e-6, 'ms': 1e-3, 's': 1, 'm': 60, 'h': 3600}
+        duration = str(duration).strip()
+        if re.match(r'^\d+(?:\.\d+)?$', duration):
+            return float(duration)
+        if not re.match(r'^(?:\d+(?:\.\d+)?(?:ns|us|ms|s|m|h))+$', duration):
+            self.module.fail_json(msg='Invalid duration %s' % duration)
+        return sum(float(number) * units[unit]
+                   for number, unit in re.findall(r'(\d+(?:\.\d+)?)(ns|us|ms|s|m|h)', duration))
+
+    def _consistency_params(self, params):
+        if self.consistency in [self.STALE, self.CONSISTENT]:
+            params[self.consistency] = ''
+            if self.consistency == self.STALE and self.max_stale:
+                params['max_stale'] = self.max_stale
         return params
 
+    def _read_metadata(self, info):
+        """Returns the staleness headers of a read, failing when the server
+        answering lost contact with the leader longer than max_stale ago"""
+        last_contact = info.get('x-consul-lastcontact')
+        last_contact = int(last_contact) if last_contact is not None else None
+        known_leader = info.get('x-consul-knownleader')
+        known_leader = known_leader == 'true' if known_leader is not None else None
+        if self.max_stale and last_contact is not None:
+            if last_contact > self._duration_seconds(self.max_stale) * 1000:
+                self.module.fail_json(msg="Read is %ims stale which is more than max_stale %s" % (last_contact, self.max_stale),
+                                      last_contact=last_contact, known_leader=known_leader)
+        return dict(last_contact=last_contact, known_leader=known_leader)
+
 
     def _add_create_body(self):
         valid_attrs = {
@@ -228,6 +383,272 @@ class ConsulACL(object):
             if hasattr(self, attr) and getattr(self, attr):
                 self.params[name] = getattr(self, attr)
 
+    def _url(self, path, params=None):
+        url = "http://%s:%s/%s/acl/%s" % (self.host, self.port, self.version, path)
+        params = urllib.urlencode(params if params is not None else self._query_params())
+        if params:
+            url = url + '?' + params
+        return url
+
+    def _api_request(self, url, data=None, method='GET', timeout=10):
+        """Makes a request and returns the status code, body and info"""
+        (response, info) = fetch_url(self.module, url, data=data, method=method, timeout=timeout)
+        if response is None:
+            return info.get('status', -1), info.get('body', info.get('msg', '')), info
+        return response.getcode(), response.read(), info
+
+    def _acls_by_name(self):
+        """Lists the ACLs once and indexes them by name, oldest first"""
+        code, body, info = self._api_request(self._url(self.LIST))
+        if code != 200:
+            self.module.fail_json(msg="Failed listing ACLs with code %i and response %s" % (code, body))
+        by_name = {}
+        for acl in sorted(json.loads(body) or [], key=lambda acl: acl.get('CreateIndex', 0)):
+            by_name.setdefault(acl.get('Name'), []).append(acl)
+        return by_name
+
+    def _hcl_tokens(self, rules):
+        tokens, pos = [], 0
+        while pos < len(rules):
+            match = self.HCL_TOKENS.match(rules, pos)
+            if not match:
+                raise ValueError('Unexpected character at %i' % pos)
+            pos = match.end()
+            quoted, punctuation, word = match.groups()
+            if quoted is not None:
+                tokens.append(('string', json.loads(quoted)))
+            elif punctuation:
+                tokens.append((punctuation, punctuation))
+            elif word:
+                tokens.append(('word', word))
+        return tokens
+
+    def _merge_rules(self, target, rules):
+        for key, value in rules.iteritems():
+            if isinstance(value, dict) and isinstance(target.get(key), dict):
+                self._merge_rules(target[key], value)
+            else:
+                target[key] = value
+
+    def _hcl_body(self, tokens, pos, closing=None):
+        """Parses the items of an HCL body up to closing, nesting labelled
+        blocks like key "foo/" { ... } as {"key": {"foo/": {...}}}"""
+        body = {}
+        while True:
+            if pos >= len(tokens):
+                if closing:
+                    raise ValueError('Missing %s' % closing)
+                return body, pos
+            if tokens[pos][0] == closing:
+                return body, pos + 1
+            if tokens[pos][0] == ',':
+                pos += 1
+                continue
+            labels = []
+            while tokens[pos][0] in ('word', 'string'):
+                labels.append(tokens[pos][1])
+                pos += 1
+            if not labels:
+                raise ValueError('Expected a key, got %s' % tokens[pos][1])
+            if tokens[pos][0] in ('=', ':'):
+                value, pos = self._hcl_value(tokens, pos + 1)
+            elif tokens[pos][0] == '{':
+                value, pos = self._hcl_body(tokens, pos + 1, '}')
+            else:
+                raise ValueError('Expected = or {, got %s' % tokens[pos][1])
+            for label in reversed(labels[1:]):
+                value = {label: value}
+            self._merge_rules(body, {labels[0]: value})
+
+    def _hcl_value(self, tokens, pos):
+        kind, token = tokens[pos]
+        if kind == 'string':
+            return token, pos + 1
+        if kind == '{':
+            return self._hcl_body(tokens, pos + 1, '}')
+        if kind == '[':
+            values, pos = [], pos + 1
+            while tokens[pos][0] != ']':
+                if tokens[pos][0] == ',':
+                    pos += 1
+                    continue
+                value, pos = self._hcl_value(tokens, pos)
+                values.append(value)
+            return values, pos + 1
+        if kind == 'word':
+            try:
+                return json.loads(token), pos + 1
+            except ValueError:
+                return token, pos + 1
+        raise ValueError('Unexpected %s' % token)
+
+    def _normalize_rules(self, rules):
+        """Returns rules, HCL or JSON, as canonical JSON. Rules that do not
+        parse are compared with their whitespace collapsed."""
+        if not rules or not rules.strip():
+            return ''
+        try:
+            parsed = json.loads(rules)
+        except ValueError:
+            try:
+                parsed = self._hcl_body(self._hcl_tokens(rules), 0)[0]
+            except (ValueError, IndexError):
+                return ' '.join(rules.split())
+        return json.dumps(parsed, sort_keys=True, separators=(',', ':'))
+
+    def _rules_hash(self, rules):
+        normalized = self._normalize_rules(rules)
+        if isinstance(normalized, unicode):
+            normalized = normalized.encode('utf-8')
+        return hashlib.sha256(normalized).hexdigest()
+
+    def _acl_differs(self, current, desired):
+        if current.get('Type') != desired['Type']:
+            return True
+        return self._rules_hash(current.get('Rules')) != self._rules_hash(desired['Rules'])
+
+    def _exit_if_unchanged(self):
+        """Skips the update when the ACL already has the same name, type
+        and normalized rules"""
+        if not self.acl_id:
+            return
+        code, body, info = self._api_request(self._url('info/%s' % self.acl_id))
+        if code != 200 or not json.loads(body or 'null'):
+            return
+        current = json.loads(body)[0]
+        desired = dict(Type=self.acl_type, Rules=self.rules or '')
+        if (current.get('Name') or '') == (self.name or '') and not self._acl_differs(current, desired):
+            self.module.exit_json(changed=False, succeeded=True, value=dict(ID=self.acl_id),
+                                  rules_hash=self._rules_hash(self.rules))
+
+    def _reconcile_ops(self, by_name):
+        """Returns the create, update and destroy ops needed for the ACLs
+        to match the desired list"""
+        ops = []
+        for acl in self.acls:
+            current = by_name.get(acl['name'], [])
+            if acl.get('state', self.PRESENT) == self.ABSENT:
+                ops.extend((self.DESTROY, acl['name'], {'ID': existing['ID']}) for existing in current)
+                continue
+            desired = OrderedDict([('Name', acl['name']), ('Type', acl.get('type') or 'client'),
+                                   ('Rules', acl.get('rules') or '')])
+            if not current:
+                ops.append((self.CREATE, acl['name'], desired))
+            elif self._acl_differs(current[0], desired):
+                desired['ID'] = current[0]['ID']
+                ops.append((self.UPDATE, acl['name'], desired))
+        return ops
+
+    def _reconcile_op(self, op):
+        action, name, body = op
+        if action == self.DESTROY:
+            code, response, info = self._api_request(self._url('destroy/%s' % body['ID']), method='PUT')
+        else:
+            code, response, info = self._api_request(self._url(action), data=json.dumps(body), method='PUT')
+        return action, name, code, response
+
+    def _reconcile(self):
+        self._validate_reconcile()
+        by_name = self._acls_by_name()
+        ops = self._reconcile_ops(by_name)
+        results = []
+        if ops:
+            pool = ThreadPool(max(1, min(self.concurrency, len(ops))))
+            try:
+                results = pool.map(self._reconcile_op, ops)
+            finally:
+                pool.close()
+        changes = OrderedDict((action, []) for action in [self.CREATE, self.UPDATE, self.DESTROY])
+        ids = OrderedDict((acl['name'], by_name[acl['name']][0]['ID']) for acl in self.acls
+                          if acl.get('state', self.PRESENT) == self.PRESENT and by_name.get(acl['name']))
+        failed = OrderedDict({})
+        for action, name, code, response in results:
+            if code != 200:
+                failed[name] = "%s failed with code %i and response %s" % (action, code, response)
+                continue
+            changes[action].append(name)
+            if action == self.CREATE:
+                ids[name] = json.loads(response)['ID']
+        result = dict(changed=any(changes.values()), created=changes[self.CREATE], updated=changes[self.UPDATE],
+                      destroyed=changes[self.DESTROY], ids=ids)
+        if failed:
+            self.module.fail_json(msg="Failed reconciling %i ACLs" % len(failed), failed_acls=failed, **result)
+        self.module.exit_json(succeeded=True, **result)
+
+    def _dc_params(self, dc, **extra):
+        # Always name the datacenter, the agent may not be in the primary
+        params = OrderedDict([('dc', dc)])
+        if self.token:
+            params['token'] = self.token
+        params.update(extra)
+        return params
+
+    def _secondary_datacenters(self):
+        if self.datacenters:
+            return [dc for dc in self.datacenters if dc != self.dc]
+        url = "http://%s:%s/%s/catalog/datacenters" % (self.host, self.port, self.version)
+        code, body, info = self._api_request(url)
+        if code != 200:
+            self.module.fail_json(msg="Failed listing datacenters with code %i and response %s" % (code, body))
+        return [dc for dc in json.loads(body) if dc != self.dc]
+
+    def _primary_index(self):
+        code, body, info = self._api_request(self._url(self.LIST, self._dc_params(self.dc)))
+        if code != 200:
+            self.module.fail_json(msg="Failed listing ACLs in %s with code %i and response %s" % (self.dc, code, body))
+        return int(info.get('x-consul-index') or 0)
+
+    def _replication_status(self, started, status, error=None):
+        replicated_index = status.get('ReplicatedIndex', 0)
+        return dict(replicated=replicated_index >= self.index and not error, replicated_index=replicated_index,
+                    lag=max(0, self.index - replicated_index), seconds=round(time.time() - started, 3),
+                    last_success=status.get('LastSuccess'), last_error=status.get('LastError'), error=error)
+
+    def _wait_for_datacenter(self, dc):
+        """Checks the replication status of dc and blocks on its ACLs, which
+        replication writes to, until the target index is replicated or the
+        deadline passes"""
+        started = time.time()
+        index, status = 0, {}
+        while True:
+            code, body, info = self._api_request(self._url(self.REPLICATION, self._dc_params(dc)))
+            if code != 200:
+                return dc, self._replication_status(started, status, "Replication status failed with code %i and response %s" % (code, body))
+            status = json.loads(body)
+            if status.get('ReplicatedIndex', 0) >= self.index:
+                return dc, self._replication_status(started, status)
+            if not status.get('Enabled'):
+                return dc, self._replication_status(started, status, 'ACL replication is not enabled')
+            remaining = self.deadline - time.time()
+            if remaining <= 0:
+                return dc, self._replication_status(started, status, 'Timed out')
+            wait = max(1, int(min(self._duration_seconds(self.wait), remaining)))
+            params = self._dc_params(dc, index=index, wait='%ds' % wait)
+            code, body, info = self._api_request(self._url(self.LIST, params), timeout=wait * 17 / 16 + 10)
+            if code != 200:
+                return dc, self._replication_status(started, status, "Listing ACLs failed with code %i and response %s" % (code, body))
+            new_index = int(info.get('x-consul-index') or 0)
+            index = new_index if new_index >= index else 0
+
+    def _wait_for_replication(self):
+        self.deadline = time.time() + self.timeout
+        if self.index is None:
+            self.index = self._primary_index()
+        datacenters = self._secondary_datacenters()
+        results = []
+        if datacenters:
+            pool = ThreadPool(max(1, min(self.concurrency, len(datacenters))))
+            try:
+                results = pool.map(self._wait_for_datacenter, datacenters)
+            finally:
+                pool.close()
+        statuses = OrderedDict(results)
+        lagging = [dc for dc, status in statuses.iteritems() if not status['replicated']]
+        if lagging:
+            self.module.fail_json(msg="ACL index %i is not replicated to %s" % (self.index, ', '.join(lagging)),
+                                  index=self.index, datacenters=statuses)
+        self.module.exit_json(changed=False, succeeded=True, index=self.index, datacenters=statuses)
+
     def _handle_response(self, response, response_body):
         code = response.getcode()
         if code != 200:
@@ -237,7 +658,10 @@ class ConsulACL(object):
                 parsed_response = json.loads(response_body)
             except:
                 parsed_response = ''
-            self.module.exit_json(changed=True, succeeded=True, value=parsed_response)
+            result = dict(changed=True, succeeded=True, value=parsed_response)
+            if self.action in self.GET_ACTIONS:
+                result.update(self._read_metadata(self.info))
+            self.module.exit_json(**result)
 
 
 def main():
@@ -246,14 +670,23 @@ def main():
         argument_spec=dict(
             acl_type=dict(required=False, default='client'),
             acl_id=dict(required=False, default=''),
+            acls=dict(required=False, type='list'),
             action=dict(required=True),
+            concurrency=dict(required=False, default=8, type='int'),
+            consistency=dict(required=False, default='default', choices=['default', 'stale', 'consistent']),
+            datacenters=dict(required=False, type='list'),
             dc=dict(required=False, default='dc1'),
             host=dict(required=False, default='127.0.0.1'),
+            index=dict(required=False, type='int'),
+            max_stale=dict(required=False),
             name=dict(required=False, default=''),
             port=dict(require=False, default=8500),
             rules=dict(required=False, default=''),
+            timeout=dict(required=False, default=300, type='int'),
             token=dict(required=False, default=''),
             version=dict(required=False, default='v1'),
+            wait=dict(required=False, default='10s'),
+            wait_for_replication=dict(required=False, default=False, type='bool'),
         ),
         supports_check_mode=True
     )
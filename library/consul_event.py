@@ -19,9 +19,14 @@
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
 import json
+import re
 import string
+import threading
+import time
+import urllib
 
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 DOCUMENTATION = '''
 ---
@@ -31,46 +36,118 @@ author: Chavez
 short_description: Interact with Consul Event API
 description:
    - Use Consul Event API in your playbooks and roles
+   - list filters by name on the server and, given the ID or LTime of the
+     last event seen, returns only the events after it along with the
+     last_id and last_ltime to pass on the next list. With a timeout it
+     blocks until new events arrive.
+   - fire with events fires a batch of events, each with its own name,
+     payload and filters, through a pool of workers limited to rate events
+     per second. Payload sizes are checked before any event is fired.
+   - fire with an ack_prefix waits, with blocking queries, for the nodes
+     handling the event to write <ack_prefix>/<event ID>/<node> keys until
+     quorum of them acked and fails with the stragglers after timeout.
 options:
+  ack_prefix:
+    description:
+      - K/V prefix the event handlers write acks under, to wait on after
+        firing a single event
+    required: false
   action:
     description:
-      - One of [leader, peers]
+      - One of [fire, list]
     required: true
+  concurrency:
+    description:
+      - Number of events fired at once with events
+    required: false
+    default: 8
   dc:
     desription:
       - The datacenter to use
     required: false
     default: dc1
+  expected_nodes:
+    description:
+      - Nodes expected to ack the event. Acks from other nodes are ignored
+        and the ones missing are reported as stragglers.
+    required: false
+  events:
+    description:
+      - Events to fire, each with a name and optionally payload, node,
+        service and tag
+    required: false
   host:
     description:
       - Consul host
     required: true
     default: 127.0.0.1
+  index:
+    description:
+      - X-Consul-Index of a previous list to block on until events change
+    required: false
+  max_event_bytes:
+    description:
+      - Largest name and payload size in bytes accepted by the agents
+    required: false
+    default: 512
   name:
     description:
-      - Name of event to fire
+      - Name of event to fire, or to filter events by on list
     required: false
   node:
     description:
       - Node query filter for event fire
     required: false
+  payload:
+    description:
+      - Payload of the event to fire, dicts and lists are sent as JSON
+    required: false
   port:
     description:
       - Consul API port
     required: true
+  quorum:
+    description:
+      - Number of acks to wait for, every expected node by default
+    required: false
+  rate:
+    description:
+      - Max events fired per second with events, 0 for no limit
+    required: false
+    default: 10
   service:
     description:
       - Service query filter for event fire
     required: false
+  since:
+    description:
+      - ID of the last event seen, list returns only the events after it
+    required: false
+  since_ltime:
+    description:
+      - LTime of the last event seen, used when since rolled out of the
+        event buffer
+    required: false
   tag:
     description:
       - Tag query filter for event fire
     required: false
+  timeout:
+    description:
+      - Seconds list blocks for new events before returning none, or fire
+        waits for acks (300 when 0)
+    required: false
+    default: 0
   version:
     description:
       - Consul API version
     required: true
     default: v1
+  wait:
+    description:
+      - Max duration of each blocking query, ie 30s
+    required: false
+    default: 30s
 
 # informational: requirements for nodes
 requirements: [ ]
@@ -82,6 +159,31 @@ EXAMPLES = '''
 
 # Get peers
 - consul_event: action=peers
+
+# Fire a reload with a payload to each service
+- consul_event:
+    action: fire
+    rate: 20
+    events:
+      - name: reload
+        service: web
+        payload: '{"version": "1.2.3"}'
+      - name: reload
+        service: api
+        payload: '{"version": "4.5.6"}'
+
+# Fire a deploy and wait for every web node to ack it
+- consul_event:
+    action: fire
+    name: deploy
+    service: web
+    ack_prefix: acks/deploy
+    expected_nodes: "{{ groups['web'] }}"
+    timeout: 600
+
+# Wait up to a minute for deploy events after the last one handled
+- consul_event: action=list name=deploy since="{{ last_event_id }}" timeout=60
+  register: deploy_events
 '''
 
 #
@@ -89,6 +191,22 @@ EXAMPLES = '''
 #
 
 
+class RateLimiter(object):
+    """Spaces calls from every thread at least 1/rate seconds apart"""
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_at = time.time()
+
+    def wait(self):
+        with self.lock:
+            now = time.time()
+            at = max(now, self.next_at)
+            self.next_at = at + self.interval
+        time.sleep(max(0, at - now))
+
+
 class ConsulEvent(object):
 
     ALLOWED_ACTIONS = ['fire', 'list']
@@ -98,23 +216,44 @@ class ConsulEvent(object):
     PUT_ACTIONS = [FIRE]
     GET_ACTIONS = [LIST]
 
+    DEFAULT_ACK_TIMEOUT = 300
+
     def __init__(self, module):
         """Takes an AnsibleModule object to set up Consul Event interaction"""
         self.module = module
+        self.ack_prefix = module.params.get('ack_prefix', None)
         self.action = string.lower(module.params.get('action', ''))
+        self.concurrency = module.params.get('concurrency', 8)
         self.dc = module.params.get('dc', 'dc1')
+        self.events = module.params.get('events', None) or []
+        self.expected_nodes = module.params.get('expected_nodes', None) or []
         self.host = module.params.get('host', '127.0.0.1')
+        self.index = module.params.get('index', None)
+        self.max_event_bytes = module.params.get('max_event_bytes', 512)
+        self.payload = module.params.get('payload', None)
         self.port = module.params.get('port', 8500)
+        self.quorum = module.params.get('quorum', None)
+        self.rate = module.params.get('rate', 10)
         self.version = module.params.get('version', 'v1')
         self.name = module.params.get('name', '')
         self.node = module.params.get('node', '')
         self.tag = module.params.get('tag', '')
         self.service = module.params.get('service', '')
+        self.since = module.params.get('since', None)
+        self.since_ltime = module.params.get('since_ltime', None)
+        self.timeout = module.params.get('timeout', 0)
+        self.wait = module.params.get('wait', '30s')
         self.params = OrderedDict({})
         self.req_data = ''
         self._build_url()
 
     def run_cmd(self):
+        if self.action == self.LIST:
+            return self._list()
+        if self.action == self.FIRE and self.ack_prefix:
+            self._validate_acks()
+        if self.action == self.FIRE and self.events:
+            return self._fire_events()
         self._make_api_call()
 
     def validate(self):
@@ -150,24 +289,198 @@ class ConsulEvent(object):
             self.module.fail_json(msg="Parsing response failed: {}, info: {}".format(str(e), info))
 
     def _setup_request(self):
-        # Add dc param if not the default
-        if self.dc != 'dc1':
-            self.api_url = self.api_url + '?dc=%s' % self.dc
         if self.action == self.FIRE:
             self._add_fire_params()
-        if self.action in self.PUT_ACTIONS:
-            if self.params:
-                self.req_data = json.dumps(self.params)
+            self.req_data = self._encode_payload(self.payload)
+            self._validate_event_size(self.name, self.req_data)
+        params = urllib.urlencode(self._query_params())
+        if params:
+            self.api_url = self.api_url + '?' + params
+
+    def _query_params(self):
+        params = OrderedDict({})
+        # Add dc param if not the default
+        if self.dc != 'dc1':
+            params['dc'] = self.dc
+        params.update(self.params)
+        if self.action in self.GET_ACTIONS:
+            if self.name:
+                params['name'] = self.name
+        return params
+
+    def _duration_seconds(self, duration):
+        """Converts a Consul duration like 500ms, 30s or 1m30s to seconds,
+        a bare number is taken as seconds"""
+        units = {'ns': 1e-9, 'us': 1e-6, 'ms': 1e-3, 's': 1, 'm': 60, 'h': 3600}
+        duration = str(duration).strip()
+        if re.match(r'^\d+(?:\.\d+)?$', duration):
+            return float(duration)
+        if not re.match(r'^(?:\d+(?:\.\d+)?(?:ns|us|ms|s|m|h))+$', duration):
+            self.module.fail_json(msg='Invalid duration %s' % duration)
+        return sum(float(number) * units[unit]
+                   for number, unit in re.findall(r'(\d+(?:\.\d+)?)(ns|us|ms|s|m|h)', duration))
 
     def _add_fire_params(self):
-        valid_params = {
-            "service": "Service",
-            "node": "Node",
-            "tag": "Tag"
-        }
-        for param, name in valid_params.iteritems():
-            if hasattr(self, param) and getattr(self, param):
-                self.params[name] = getattr(self, param)
+        # The API takes the node, service and tag filters as query params
+        for param in self.FIRE_PARAMS:
+            if getattr(self, param, None):
+                self.params[param] = getattr(self, param)
+
+    def _encode_payload(self, payload):
+        if payload is None:
+            return ''
+        if isinstance(payload, (dict, list)):
+            return json.dumps(payload)
+        if isinstance(payload, unicode):
+            return payload.encode('utf-8')
+        return str(payload)
+
+    def _event_size_error(self, name, payload):
+        size = len(name or '') + len(payload)
+        if size > self.max_event_bytes:
+            return "Event %s is %i bytes with its payload, more than %i" % (name, size, self.max_event_bytes)
+        return None
+
+    def _validate_event_size(self, name, payload):
+        error = self._event_size_error(name, payload)
+        if error:
+            self.module.fail_json(msg=error)
+
+    def _fire_event(self, event):
+        self.limiter.wait()
+        params = OrderedDict({})
+        if self.dc != 'dc1':
+            params['dc'] = self.dc
+        params.update((param, event[param]) for param in self.FIRE_PARAMS if event.get(param))
+        url = "http://%s:%s/%s/event/fire/%s" % (self.host, self.port, self.version, urllib.quote(event['name']))
+        if params:
+            url = url + '?' + urllib.urlencode(params)
+        code, body, info = self._api_request(url, data=event['payload'], method='PUT')
+        return event['name'], code, body
+
+    def _fire_events(self):
+        """Checks every event before firing any, then fires them through a
+        pool of workers sharing one rate limiter"""
+        events, errors = [], []
+        for event in self.events:
+            if not isinstance(event, dict) or not event.get('name'):
+                self.module.fail_json(msg='Every event needs a name: %s' % event)
+            event = dict(event, payload=self._encode_payload(event.get('payload')))
+            errors.append(self._event_size_error(event['name'], event['payload']))
+            events.append(event)
+        errors = filter(None, errors)
+        if errors:
+            self.module.fail_json(msg='Events are too large: %s' % '; '.join(errors))
+        self.limiter = RateLimiter(self.rate)
+        pool = ThreadPool(max(1, min(self.concurrency, len(events))))
+        try:
+            results = pool.map(self._fire_event, events)
+        finally:
+            pool.close()
+        fired, failed = [], []
+        for name, code, body in results:
+            if code == 200:
+                fired.append(json.loads(body))
+            else:
+                failed.append(dict(name=name, msg="Failed with code %i and response %s" % (code, body)))
+        if failed:
+            self.module.fail_json(msg="Failed firing %i of %i events" % (len(failed), len(events)),
+                                  changed=bool(fired), value=fired, failed_events=failed)
+        self.module.exit_json(changed=True, succeeded=True, value=fired)
+
+    def _api_request(self, url, data=None, method='GET', timeout=10):
+        """Makes a request and returns the status code, body and info"""
+        (response, info) = fetch_url(self.module, url, data=data, method=method, timeout=timeout)
+        if response is None:
+            return info.get('status', -1), info.get('body', info.get('msg', '')), info
+        return response.getcode(), response.read(), info
+
+    def _events_since(self, events):
+        """Returns the events after the cursor, all of them without one"""
+        if self.since:
+            for position, event in enumerate(events):
+                if event.get('ID') == self.since:
+                    return events[position + 1:]
+        if self.since_ltime is not None:
+            return [event for event in events if event.get('LTime', 0) > self.since_ltime]
+        return events
+
+    def _list(self):
+        """Lists events, blocking on the event index while there are no new
+        events and the timeout has not passed"""
+        deadline = time.time() + self.timeout
+        index = self.index
+        while True:
+            params = self._query_params()
+            timeout = 10
+            if index:
+                wait = self._duration_seconds(self.wait)
+                if self.timeout:
+                    wait = min(wait, deadline - time.time())
+                wait = max(1, int(wait))
+                params['index'] = index
+                params['wait'] = '%ds' % wait
+                timeout = wait * 17 / 16 + 10
+            code, body, info = self._api_request("%s?%s" % (self.api_url, urllib.urlencode(params)), timeout=timeout)
+            if code != 200:
+                self.module.fail_json(msg="Failed with code %i and response %s" % (code, body))
+            # The event index is a hash of the latest event, not a counter
+            index = info.get('x-consul-index') or index
+            events = json.loads(body) or []
+            new_events = self._events_since(events)
+            if new_events or not self.timeout or time.time() >= deadline:
+                break
+        last = events[-1] if events else {}
+        result = dict(changed=True, succeeded=True, value=new_events, index=index,
+                      last_id=last.get('ID', self.since), last_ltime=last.get('LTime', self.since_ltime))
+        self.module.exit_json(**result)
+
+    def _validate_acks(self):
+        if self.events:
+            self.module.fail_json(msg='Waiting for acks takes a single event, not events')
+        if not self.quorum and not self.expected_nodes:
+            self.module.fail_json(msg='Waiting for acks requires a quorum or expected_nodes')
+        if self.expected_nodes and self.quorum > len(self.expected_nodes):
+            self.module.fail_json(msg='Quorum %i is more than the %i expected nodes' % (self.quorum, len(self.expected_nodes)))
+
+    def _wait_for_acks(self, event):
+        """Blocks on the keys under the event's ack prefix until quorum of
+        the nodes acked or the timeout passes"""
+        started = time.time()
+        deadline = started + (self.timeout or self.DEFAULT_ACK_TIMEOUT)
+        prefix = '%s/%s/' % (self.ack_prefix.strip('/'), event['ID'])
+        quorum = self.quorum or len(self.expected_nodes)
+        index = 0
+        while True:
+            params = OrderedDict({})
+            if self.dc != 'dc1':
+                params['dc'] = self.dc
+            params['keys'] = ''
+            timeout = 10
+            if index:
+                wait = max(1, int(min(self._duration_seconds(self.wait), deadline - time.time())))
+                params['index'] = index
+                params['wait'] = '%ds' % wait
+                timeout = wait * 17 / 16 + 10
+            url = "http://%s:%s/%s/kv/%s?%s" % (self.host, self.port, self.version, prefix, urllib.urlencode(params))
+            code, body, info = self._api_request(url, timeout=timeout)
+            if code not in [200, 404]:
+                self.module.fail_json(msg="Failed reading acks with code %i and response %s" % (code, body),
+                                      changed=True, value=event)
+            acked = set(key[len(prefix):].split('/')[0] for key in (json.loads(body) if code == 200 else []))
+            acked.discard('')
+            if self.expected_nodes:
+                acked &= set(self.expected_nodes)
+            new_index = int(info.get('x-consul-index') or 0)
+            index = new_index if new_index >= index else 0
+            if len(acked) >= quorum or time.time() >= deadline:
+                break
+        result = dict(changed=True, value=event, acked=sorted(acked), quorum=quorum,
+                      stragglers=sorted(set(self.expected_nodes) - acked), seconds=round(time.time() - started, 3))
+        if len(acked) < quorum:
+            self.module.fail_json(msg="Only %i of %i acks for event %s before the timeout" % (len(acked), quorum, event['ID']),
+                                  **result)
+        self.module.exit_json(succeeded=True, **result)
 
     def _handle_response(self, response, response_body):
         code = response.getcode()
@@ -178,22 +491,38 @@ class ConsulEvent(object):
                 parsed_response = json.loads(response_body)
             except:
                 parsed_response = ''
-            self.module.exit_json(changed=True, succeeded=True, value=parsed_response)
+            result = dict(changed=True, succeeded=True, value=parsed_response)
+            if self.action == self.FIRE and self.ack_prefix:
+                self._wait_for_acks(parsed_response)
+            self.module.exit_json(**result)
 
 
 def main():
     global module
     module = AnsibleModule(
         argument_spec=dict(
+            ack_prefix=dict(required=False),
             action=dict(required=True),
+            concurrency=dict(required=False, default=8, type='int'),
             dc=dict(required=False, default='dc1'),
+            events=dict(required=False, type='list'),
+            expected_nodes=dict(required=False, type='list'),
             host=dict(required=False, default='127.0.0.1'),
+            index=dict(required=False),
+            max_event_bytes=dict(required=False, default=512, type='int'),
             name=dict(required=False, default=''),
             node=dict(required=False, default=''),
+            payload=dict(required=False, type='raw'),
             port=dict(require=False, default=8500),
+            quorum=dict(required=False, type='int'),
+            rate=dict(required=False, default=10, type='float'),
             service=dict(required=False, default=''),
+            since=dict(required=False),
+            since_ltime=dict(required=False, type='int'),
             tag=dict(required=False, default=''),
+            timeout=dict(required=False, default=0, type='int'),
             version=dict(required=False, default='v1'),
+            wait=dict(required=False, default='30s'),
         ),
         supports_check_mode=True
     )
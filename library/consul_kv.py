@@ -19,11 +19,24 @@
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
 import base64
+import collections
+import copy
+import fnmatch
+import gzip
+import hashlib
+import heapq
+import itertools
 import json
+import os
+import random
+import re
 import string
+import time
 import urllib
+import zlib
 
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 
 DOCUMENTATION = '''
@@ -41,35 +54,150 @@ options:
     required: false
   action:
     description:
-      - HTTP verb [GET, PUT, DELETE]
+      - HTTP verb [GET, PUT, DELETE], EXPORT and IMPORT to stream a
+        prefix to and from a local file, ANALYZE to report usage per
+        subtree of a prefix, or PATCH to apply a JSON merge patch to a
+        JSON value with check and set retries
     required: true
+  checkpoint:
+    description:
+      - File recording import progress so an interrupted import resumes
+        where it stopped. Defaults to path with a .checkpoint suffix.
+    required: false
+  compare:
+    description:
+      - Read the current values and flags with one recursive GET first and
+        only PUT the keys that differ. Reports accurate changed and diff.
+    required: false
+    default: False
+  compress:
+    description:
+      - zlib compress values on PUT and mark them in flags. Values still
+        larger than 512KB once compressed are split across chunk keys under
+        key.chunks/ with a manifest at key. GET detects the marker flags and
+        returns decompressed values, including on recursive reads.
+    required: false
+    default: False
+  consistency:
+    description:
+      - Consistency mode for reads [default, stale, consistent], including
+        the reads of walk, EXPORT, ANALYZE, compare and sync. stale lets any
+        server answer the read instead of the leader.
+    required: false
+    default: default
+  concurrency:
+    description:
+      - Number of datacenters written to at once when dc is a list
+    required: false
+    default: 8
   dc:
     desription:
-      - The datacenter to use
+      - The datacenter to use. PUT and DELETE also take a list, or a
+        comma separated string, of datacenters or all to use every known
+        datacenter, and write to them concurrently naming each one.
     required: false
     default: dc1
+  depth:
+    description:
+      - Number of separator levels below key to expand when walking, deeper
+        folders are returned instead of expanded. For ANALYZE the number of
+        levels below key to group usage by, defaults to 1. Keys above depth
+        are counted under their parent folder.
+    required: false
+  decode:
+    description:
+      - Base64 decode values on GET. When false values are returned as
+        stored by the API.
+    required: false
+    default: True
+  backoff:
+    description:
+      - Base seconds of the jittered exponential backoff between PATCH
+        retries, capped at 5 seconds
+    required: false
+    default: 0.1
   cas:
     description:
       - Check and set parameter
     require: false
+  fields:
+    description:
+      - Only return these fields of each entry on GET, ie Key, ModifyIndex, Value
+    required: false
   flags:
     description:
       - Opaque flag to set as metadata for a key
     require: false
+  gzip:
+    description:
+      - Gzip compress the file written by EXPORT or read by IMPORT
+    required: false
+    default: False
   host:
     description:
       - Consul host
     required: true
     default: 127.0.0.1
+  include:
+    description:
+      - Only return walked keys matching one of these patterns
+    required: false
+  index:
+    description:
+      - Index for a blocking GET. The request waits until the key changes
+        past this index or wait expires. With wait_for modified the key's
+        ModifyIndex must pass this index.
+    required: false
+  items:
+    description:
+      - List of items to PUT in bulk through the transaction endpoint. Each
+        item is a dict with a key, value and optional flags and cas. Items are
+        sent in chunks that fit the per-transaction limits. When key is also
+        given it is used as a prefix for every item key.
+    required: false
   key:
     description:
-      - Key to interact with in K/V store
-    required: true
+      - Key to interact with in K/V store, required unless items are given
+    required: false
   keys:
     description:
       - Return keys on a GET request for a given path
     required: false
     default: False
+  limit:
+    description:
+      - Stop walking once this many keys matched and return truncated
+    required: false
+  match:
+    description:
+      - How include patterns match keys [glob, regex]
+    required: false
+    default: glob
+  max_decoded_bytes:
+    description:
+      - Stop decoding values on GET once this many bytes have been decoded.
+        Values past the limit are returned as null and counted in truncated.
+    required: false
+  max_stale:
+    description:
+      - With stale consistency, fail when the answering server last heard
+        from the leader longer ago than this duration, ie 5s
+    required: false
+  page_size:
+    description:
+      - Number of keys read per transaction by EXPORT and ANALYZE, at most 64
+    required: false
+    default: 64
+  patch:
+    description:
+      - JSON merge patch (RFC 7386) applied to the JSON value of key by
+        PATCH, as a dict or a JSON string. Keys set to null are removed.
+    required: false
+  path:
+    description:
+      - Local file for EXPORT and IMPORT holding one JSON entry per line
+        with Key, Flags and the base64 Value
+    required: false
   port:
     description:
       - Consul API port
@@ -83,17 +211,60 @@ options:
     - description:
       - Session to release for PUT requests
     required: false
+  retries:
+    description:
+      - Number of times PATCH retries after a concurrent write changed the
+        key between its GET and check and set PUT
+    required: false
+    default: 10
   separator:
     description:
       - Separator to use when listing keys for a GET
     required: false
+  state:
+    description:
+      - Use synced with a PUT of items to make the key prefix hold exactly
+        the given items. Missing keys are created, changed keys updated and
+        extra keys deleted in batched transactions guarded by check and set.
+        Items are required, only an empty list deletes every key under the
+        prefix.
+    required: false
+    choices: [synced]
+  timeout:
+    description:
+      - Overall seconds to keep blocking when using wait_for
+    required: false
+    default: 300
   token:
     description:
       - ACL token to use with requests
+  top:
+    description:
+      - Number of largest keys reported by ANALYZE
+    required: false
+    default: 10
   value:
     description:
-      - Value to set when adding or updating a key
+      - Value to set when adding or updating a key, or to match with
+        wait_for value
+    required: false
+  wait:
+    description:
+      - Max duration of a blocking GET, ie 30s or 5m. Defaults to 5m, as
+        Consul does, when an index is given.
+    required: false
+  wait_for:
+    description:
+      - Long-poll a GET with blocking queries until the key exists, holds
+        value, or has been modified past index. Fails after timeout.
     required: false
+    choices: [exists, value, modified]
+  walk:
+    description:
+      - Walk the keys under key on GET one separator level at a time, using
+        separator or /, instead of listing every key in one response
+    required: false
+    default: False
   version:
     description:
       - Consul API version
@@ -125,9 +296,59 @@ EXAMPLES = '''
 # PUT with session release
 - consul_kv: action=put key=razzle/acquired value="true" acquire="some-valid-session release="some-valid-session" "
 
+# PUT many keys through transactions
+- consul_kv:
+    action: put
+    key: app/config/
+    items:
+      - key: db/host
+        value: db.local
+      - key: db/port
+        value: 5432
+        flags: 1
+      - key: db/user
+        value: app
+        cas: 0
+
+# PUT only the items that differ from what is stored
+- consul_kv:
+    action: put
+    key: app/config/
+    compare: true
+    items:
+      - key: db/host
+        value: db.local
+      - key: db/port
+        value: 5432
+
+# Make a prefix hold exactly the keys in a dict
+- consul_kv:
+    action: put
+    key: app/config/
+    state: synced
+    items: "{{ app_config | dict2items }}"
+
+# PUT a large document compressed
+- consul_kv: action=put key=app/catalog.json value="{{ catalog | to_json }}" compress=true
+
 # GET a value for a key
 - consul_kv: action=get key=foo/bar/baz
 
+# GET blocking until the key changes past an index
+- consul_kv: action=get key=foo/bar/baz index={{ baz.index }} wait=30s
+
+# Wait for a key to hold a value
+- consul_kv: action=get key=deploy/status wait_for=value value=done timeout=600
+
+# GET from any server as long as it is at most 5s behind the leader
+- consul_kv: action=get key=foo/bar/baz consistency=stale max_stale=5s
+
+# GET only keys and indexes of a large prefix without values
+- consul_kv: action=get key=app/ recurse=true fields=Key,ModifyIndex
+
+# GET a prefix decoding at most 1MB of values
+- consul_kv: action=get key=app/ recurse=true max_decoded_bytes=1048576
+
 # GET keys for prefix
 - consul_kv: action=get key=bar keys=true
   register: bar_keys
@@ -136,6 +357,41 @@ EXAMPLES = '''
 - consul_kv: action=get key=bar/ keys=true separator='/'
   register: separator_keys
 
+# Walk two levels of keys matching a pattern
+- consul_kv: action=get key=app/ walk=true depth=2 include="app/*/config/*" limit=100
+
+# EXPORT a prefix to a gzipped file
+- consul_kv: action=export key=app/ path=/tmp/app.jsonl.gz gzip=true
+
+# IMPORT a file, resuming from its checkpoint if interrupted
+- consul_kv: action=import path=/tmp/app.jsonl.gz gzip=true
+
+# PUT a key into several datacenters at once
+- consul_kv:
+    action: put
+    key: global/feature
+    value: "on"
+    dc:
+      - dc1
+      - dc2
+
+# DELETE a key from every datacenter
+- consul_kv: action=delete key=global/old_feature dc=all
+
+# Report key counts and sizes per subtree
+- consul_kv: action=analyze key=app/ depth=2
+  register: app_usage
+
+# PATCH one field of a shared JSON document
+- consul_kv:
+    action: patch
+    key: app/settings.json
+    patch:
+      features:
+        new_ui: true
+        old_ui: null
+    retries: 20
+
 # DELETE a key
 - consul_kv: action=delete key=foo/tmp
 
@@ -148,64 +404,245 @@ EXAMPLES = '''
 #
 
 
+class DatacenterExit(Exception):
+
+    def __init__(self, failed, result):
+        Exception.__init__(self, result.get('msg', ''))
+        self.failed = failed
+        self.result = result
+
+
+class DatacenterModule(object):
+    """Stands in for the AnsibleModule while writing to one of several
+    datacenters so exiting raises the result back to the worker pool
+    instead of exiting from a thread"""
+
+    def __init__(self, module):
+        self.module = module
+
+    def __getattr__(self, name):
+        return getattr(self.module, name)
+
+    def exit_json(self, **kwargs):
+        raise DatacenterExit(False, kwargs)
+
+    def fail_json(self, **kwargs):
+        raise DatacenterExit(True, kwargs)
+
+
 class ConsulKV(object):
 
-    ALLOWED_ACTIONS = ['GET', 'PUT', 'DELETE']
-    GET, PUT, DELETE = ALLOWED_ACTIONS
+    ALLOWED_ACTIONS = ['GET', 'PUT', 'DELETE', 'EXPORT', 'IMPORT', 'ANALYZE', 'PATCH']
+    GET, PUT, DELETE, EXPORT, IMPORT, ANALYZE, PATCH = ALLOWED_ACTIONS
+
+    MAX_BACKOFF = 5
+
+    SYNCED = 'synced'
+    MATCH_TYPES = ['glob', 'regex']
+    GLOB, REGEX = MATCH_TYPES
+    ALL_DATACENTERS = 'all'
+
+    CONSISTENCY_MODES = ['default', 'stale', 'consistent']
+    DEFAULT, STALE, CONSISTENT = CONSISTENCY_MODES
+
+    WAIT_FOR = ['exists', 'value', 'modified']
+    EXISTS, VALUE, MODIFIED = WAIT_FOR
+    DEFAULT_WAIT = '5m'
+
+    # Consul rejects transactions with more than 64 operations or
+    # a request body larger than the max K/V value size
+    TXN_MAX_OPS = 64
+    TXN_MAX_BYTES = 512 * 1024
+    MAX_VALUE_BYTES = 512 * 1024
+
+    # High bits of flags mark compressed values and sharded values split
+    # into chunk keys under key.chunks/ with a manifest at the key
+    COMPRESSED_FLAG = 1 << 62
+    MANIFEST_FLAG = 1 << 61
+    CHUNK_FLAG = 1 << 60
+    MARKER_FLAGS = COMPRESSED_FLAG | MANIFEST_FLAG | CHUNK_FLAG
+    CHUNK_SUFFIX = '.chunks/'
 
     def __init__(self, module):
         """Takes an AnsibleModule object to set up Consul K/V interaction"""
         self.module = module
         self.acquire = module.params.get('acquire', None)
+        self.backoff = module.params.get('backoff', 0.1)
         self.action = string.upper(module.params.get('action', ''))
         self.cas = module.params.get('cas', None)
-        self.dc = module.params.get('dc', 'dc1')
+        self.checkpoint = module.params.get('checkpoint', None)
+        self.body = None
+        self.chunks = {}
+        self.compare = module.params.get('compare', False)
+        self.compress = module.params.get('compress', False)
+        self.consistency = module.params.get('consistency', self.DEFAULT)
+        self.concurrency = module.params.get('concurrency', 8)
+        self.datacenters = module.params.get('dc', None) or ['dc1']
+        self.dc = self.datacenters[0]
+        self.depth = module.params.get('depth', None)
+        self.decode = module.params.get('decode', True)
+        self.decoded_bytes = 0
+        self.fields = module.params.get('fields', None)
         self.flags = module.params.get('flags', None)
+        self.gzip = module.params.get('gzip', False)
         self.host = module.params.get('host', '127.0.0.1')
-        self.key = module.params.get('key', '')
+        self.include = module.params.get('include', None)
+        self.index = module.params.get('index', None)
+        self.items = module.params.get('items', None)
+        self.key = module.params.get('key', '') or ''
         self.keys = module.params.get('keys', False)
+        self.limit = module.params.get('limit', None)
+        self.manifests = []
+        self.match = module.params.get('match', self.GLOB)
+        self.max_decoded_bytes = module.params.get('max_decoded_bytes', None)
+        self.max_stale = module.params.get('max_stale', None)
+        self.page_size = module.params.get('page_size', self.TXN_MAX_OPS)
+        self.patch = module.params.get('patch', None)
+        self.path = module.params.get('path', None)
         self.port = module.params.get('port', 8500)
         self.recurse = module.params.get('recurse', False)
         self.release = module.params.get('release', None)
+        self.retries = module.params.get('retries', 10)
         self.separator = module.params.get('separator', None)
+        self.state = module.params.get('state', None)
+        self.timeout = module.params.get('timeout', 300)
+        self.top = module.params.get('top', 10)
+        self.truncated = 0
         self.token = module.params.get('token', None)
         self.value = module.params.get('value', '')
         self.version = module.params.get('version', 'v1')
+        self.wait = module.params.get('wait', None)
+        if self.index is not None and not self.wait:
+            # Send Consul's default wait so the request timeout covers it
+            self.wait = self.DEFAULT_WAIT
+        self.wait_for = module.params.get('wait_for', None)
+        self.walk = module.params.get('walk', False)
         self._build_url()
+        self._build_txn_url()
 
     def run_cmd(self):
         self.validate()
-        self._make_api_call()
+        if self.action == self.EXPORT:
+            self._export()
+        elif self.action == self.IMPORT:
+            self._import()
+        elif self.action == self.ANALYZE:
+            self._analyze()
+        elif self.action == self.PATCH:
+            self._patch()
+        elif self.wait_for:
+            self._wait_for_key()
+        elif self.action == self.GET and self.walk:
+            self._walk()
+        elif self._multiple_datacenters():
+            self._write_datacenters()
+        else:
+            self._run_action()
+
+    def _run_action(self):
+        if self.state == self.SYNCED:
+            self._sync_items()
+        elif self.items:
+            self._put_items()
+        else:
+            if self.action == self.PUT and self.compare:
+                self._exit_if_unchanged()
+            if self.action == self.PUT and self.compress:
+                self._compress_value()
+            self._make_api_call()
 
     def validate(self):
         # Check action is allowed
         if not self.action or self.action not in self.ALLOWED_ACTIONS:
-            self.module.fail_json(msg='Action is required and must be one of GET, PUT, DELETE')
+            self.module.fail_json(msg='Action is required and must be one of %s' % ', '.join(self.ALLOWED_ACTIONS))
         # A key is required for any call so make sure one exists
-        if not self.key:
+        if not self.key and not self.items and self.action != self.IMPORT:
             self.module.fail_json(msg='A key is required to interact with the k/v API')
+        if self.wait_for and self.action != self.GET:
+            self.module.fail_json(msg='wait_for can only be used with GET')
         # Validate action being used
         # ie self._validate_get(), self._validate_put(), self._validate_delete()
-        getattr(self, "_validate_%s" % string.lower(self.action))
+        getattr(self, "_validate_%s" % string.lower(self.action))()
+        self._validate_datacenters()
 
     def _build_url(self):
         self.api_url = "http://%s:%s/%s/kv/%s" % (self.host, self.port, self.version, self.key)
 
+    def _build_txn_url(self):
+        self.txn_url = "http://%s:%s/%s/txn" % (self.host, self.port, self.version)
+
     def _validate_get(self):
-        pass
+        if self.items is not None or self.state:
+            self.module.fail_json(msg='Items and state can only be used with PUT')
+        if self.wait_for == self.MODIFIED and self.index is None:
+            self.module.fail_json(msg='An index is required to wait for a modified key')
+        if self.wait_for == self.VALUE and self.value is None:
+            self.module.fail_json(msg='A value is required to wait for a key value')
 
     def _validate_put(self):
-        if not self.value:
+        if self.state == self.SYNCED and not self.key:
+            self.module.fail_json(msg='A key prefix is required to sync items')
+        if self.state == self.SYNCED and self.items is None:
+            # An omitted items list must never empty the prefix
+            self.module.fail_json(msg='Items are required to sync, use [] to delete every key under the prefix')
+        if self.items:
+            self._validate_items()
+        elif self.state != self.SYNCED and not self.value:
             self.module.fail_json(msg='A value is required when using PUT')
 
+    def _validate_items(self):
+        for item in self.items:
+            if not isinstance(item, dict) or not item.get('key'):
+                self.module.fail_json(msg='Each item requires a key: %r' % item)
+            if item.get('value') is None:
+                self.module.fail_json(msg='A value is required for item %s' % item['key'])
+
+    def _validate_export(self):
+        if not self.path:
+            self.module.fail_json(msg='A path is required to export')
+        self._validate_page_size()
+
+    def _validate_page_size(self):
+        if not 0 < self.page_size <= self.TXN_MAX_OPS:
+            self.module.fail_json(msg='Page size must be between 1 and %i' % self.TXN_MAX_OPS)
+
+    def _validate_import(self):
+        if not self.path:
+            self.module.fail_json(msg='A path is required to import')
+        if not os.path.exists(self.path):
+            self.module.fail_json(msg='Import file %s does not exist' % self.path)
+
+    def _validate_analyze(self):
+        if self.items is not None or self.state:
+            self.module.fail_json(msg='Items and state can only be used with PUT')
+        if self.depth is not None and self.depth < 1:
+            self.module.fail_json(msg='Depth must be at least 1 to analyze')
+        self._validate_page_size()
+
+    def _validate_patch(self):
+        if self.patch is None:
+            self.module.fail_json(msg='A patch is required to PATCH a key')
+        if isinstance(self.patch, basestring):
+            try:
+                self.patch = json.loads(self.patch, object_pairs_hook=OrderedDict)
+            except ValueError, e:
+                self.module.fail_json(msg='Patch is not valid JSON: %s' % str(e))
+
     def _validate_delete(self):
-        pass
+        if self.items is not None or self.state:
+            self.module.fail_json(msg='Items and state can only be used with PUT')
+
+    def _validate_datacenters(self):
+        if self._multiple_datacenters() and self.action not in [self.PUT, self.DELETE]:
+            self.module.fail_json(msg='Multiple datacenters can only be used with PUT or DELETE')
 
     def _make_api_call(self):
         self._setup_request()
 
         try:
-            (response, info) = fetch_url(module, self.api_url, data=self.value, method=self.action)
+            (response, info) = fetch_url(module, self.api_url, data=self.value if self.body is None else self.body, method=self.action,
+                                         timeout=self._request_timeout(self.wait))
+            self.info = info
         except urllib2.URLError, e:
             self.module.fail_json(msg="API call failed: {}, info: {}".format(str(e), info))
 
@@ -215,17 +652,28 @@ class ConsulKV(object):
         except AttributeError, e:
             self.module.fail_json(msg="Parsing response failed: {}".format(str(e), info))
 
+    def _api_request(self, url, data=None, method='GET', timeout=10):
+        """Makes a request and returns the status code, body and info
+        without exiting so callers can collect results"""
+        (response, info) = fetch_url(self.module, url, data=data, method=method, timeout=timeout)
+        if response is None:
+            return info.get('status', -1), info.get('body', info.get('msg', '')), info
+        return response.getcode(), response.read(), info
 
     def _query_params(self):
-        params = OrderedDict({})
-        if self.dc != 'dc1':
-            params['dc'] = self.dc
+        params = self._datacenter_params(OrderedDict({}))
         if self.token:
             params['token'] = self.token
-        if self.action == self.DELETE and self.recurse:
+        if self.action in [self.DELETE, self.GET] and self.recurse:
             params['recurse'] = 'true'
         if self.action in [self.DELETE, self.PUT] and self.cas:
             params['cas'] = self.cas
+        if self.action == self.GET:
+            self._consistency_params(params)
+        if self.action == self.GET and self.index is not None:
+            params['index'] = self.index
+            if self.wait:
+                params['wait'] = self.wait
         if self.action == self.GET and self.keys:
             if self.separator:
                 params['separator'] = self.separator
@@ -244,20 +692,768 @@ class ConsulKV(object):
         if params:
             self.api_url = self.api_url + '?' + params
 
+    def _duration_seconds(self, duration):
+        """Converts a Consul duration like 500ms, 30s or 1m30s to seconds,
+        a bare number is taken as seconds"""
+        units = {'ns': 1e-9, 'us': 1e-6, 'ms': 1e-3, 's': 1, 'm': 60, 'h': 3600}
+        duration = str(duration).strip()
+        if re.match(r'^\d+(?:\.\d+)?$', duration):
+            return float(duration)
+        if not re.match(r'^(?:\d+(?:\.\d+)?(?:ns|us|ms|s|m|h))+$', duration):
+            self.module.fail_json(msg='Invalid duration %s' % duration)
+        return sum(float(number) * units[unit]
+                   for number, unit in re.findall(r'(\d+(?:\.\d+)?)(ns|us|ms|s|m|h)', duration))
+
+    def _consistency_params(self, params):
+        if self.consistency in [self.STALE, self.CONSISTENT]:
+            params[self.consistency] = ''
+            if self.consistency == self.STALE and self.max_stale:
+                params['max_stale'] = self.max_stale
+        return params
+
+    def _read_metadata(self, info):
+        """Returns the staleness headers of a read, failing when the server
+        answering lost contact with the leader longer than max_stale ago"""
+        last_contact = info.get('x-consul-lastcontact')
+        last_contact = int(last_contact) if last_contact is not None else None
+        known_leader = info.get('x-consul-knownleader')
+        known_leader = known_leader == 'true' if known_leader is not None else None
+        if self.max_stale and last_contact is not None:
+            if last_contact > self._duration_seconds(self.max_stale) * 1000:
+                self.module.fail_json(msg="Read is %ims stale which is more than max_stale %s" % (last_contact, self.max_stale),
+                                      last_contact=last_contact, known_leader=known_leader)
+        return dict(last_contact=last_contact, known_leader=known_leader)
+
+    def _request_timeout(self, wait):
+        # Consul adds up to wait/16 of jitter to a blocking query
+        if not wait:
+            return 10
+        return int(self._duration_seconds(wait) * 17 / 16) + 10
+
+    def _url_with_params(self, url, params):
+        params = urllib.urlencode(params)
+        if params:
+            url = url + '?' + params
+        return url
+
+    def _kv_url(self, key, params):
+        return self._url_with_params("http://%s:%s/%s/kv/%s" % (self.host, self.port, self.version, key), params)
+
+    def _datacenter_params(self, params):
+        # Writes to several datacenters name each one so none of them
+        # lands in the local datacenter of the agent by default
+        if self.dc != 'dc1' or self._multiple_datacenters():
+            params['dc'] = self.dc
+        return params
+
+    def _base_query_params(self):
+        params = self._datacenter_params(OrderedDict({}))
+        if self.token:
+            params['token'] = self.token
+        return params
+
+    def _read_params(self):
+        return self._consistency_params(self._base_query_params())
+
+    def _encode_value(self, value):
+        if not isinstance(value, basestring):
+            value = json.dumps(value)
+        return value
+
+    def _item_key(self, item):
+        return self.key + item['key']
+
+    def _txn_set_op(self, item):
+        op = OrderedDict({})
+        op['Key'] = self._item_key(item)
+        op['Value'] = base64.b64encode(self._stored_value(item['value']))
+        if item.get('flags') is not None or self.compress:
+            op['Flags'] = self._stored_flags(item.get('flags'))
+        if item.get('cas') is not None:
+            op['Verb'] = 'cas'
+            op['Index'] = int(item['cas'])
+        else:
+            op['Verb'] = 'set'
+        op = {'KV': op}
+        # Fail before any transaction is sent rather than part way through
+        self._op_bytes(op)
+        return op
+
+    def _op_bytes(self, op):
+        """Returns the size of an op in a transaction body, which holds
+        values base64 encoded, failing when it can not fit in any"""
+        op_bytes = len(json.dumps(op))
+        # A transaction of one op still has the list brackets around it
+        if op_bytes + 2 > self.TXN_MAX_BYTES:
+            self.module.fail_json(msg='Item %s is %i bytes encoded which is too large for a transaction, PUT it on its own with compress to shard it' % (op['KV']['Key'], op_bytes))
+        return op_bytes
+
+    def _txn_chunks(self, ops):
+        """Groups ops so each transaction body, a JSON list of the ops,
+        stays under the op and size limits"""
+        chunk, chunk_bytes = [], 2
+        for op in ops:
+            # Every op after the first adds a ', ' separator
+            op_bytes = self._op_bytes(op) + 2
+            if chunk and (len(chunk) >= self.TXN_MAX_OPS or chunk_bytes + op_bytes > self.TXN_MAX_BYTES):
+                yield chunk
+                chunk, chunk_bytes = [], 2
+            chunk.append(op)
+            chunk_bytes += op_bytes if len(chunk) > 1 else op_bytes - 2
+        if chunk:
+            yield chunk
+
+    def _apply_txn(self, ops):
+        """Sends one transaction and returns a result per op"""
+        url = self._url_with_params(self.txn_url, self._base_query_params())
+        code, body, info = self._api_request(url, data=json.dumps(ops), method='PUT')
+        keys = [op['KV']['Key'] for op in ops]
+        verbs = [op['KV']['Verb'] for op in ops]
+        if code == 200:
+            parsed = json.loads(body)
+            entries = dict((r['KV']['Key'], r['KV']) for r in parsed.get('Results') or [] if r.get('KV'))
+            return [dict(key=key, verb=verb, succeeded=True, modify_index=entries.get(key, {}).get('ModifyIndex'))
+                    for key, verb in zip(keys, verbs)]
+        if code == 409:
+            # The transaction is rolled back when any op fails
+            try:
+                errors = dict((e['OpIndex'], e['What']) for e in json.loads(body).get('Errors') or [])
+            except ValueError:
+                errors = {}
+            return [dict(key=key, verb=verb, succeeded=False, error=errors.get(i, 'rolled back'))
+                    for i, (key, verb) in enumerate(zip(keys, verbs))]
+        error = "Failed with code %i because %s" % (code, body)
+        return [dict(key=key, verb=verb, succeeded=False, error=error) for key, verb in zip(keys, verbs)]
+
+    def _run_txn(self, ops):
+        results = []
+        for chunk in self._txn_chunks(ops):
+            results += self._apply_txn(chunk)
+        return results
+
+    def _read_tree(self, prefix):
+        """Reads every entry under a prefix with one recursive GET and
+        returns them indexed by key"""
+        params = self._read_params()
+        params['recurse'] = 'true'
+        code, body, info = self._api_request(self._kv_url(prefix, params))
+        if code == 404:
+            return {}
+        if code != 200:
+            self.module.fail_json(msg="Failed reading %s with a %i because %s" % (prefix, code, body))
+        self._read_metadata(info)
+        entries = json.loads(body)
+        chunks = dict((obj['Key'], base64.b64decode(obj.get('Value') or ''))
+                      for obj in entries if obj.get('Flags', 0) & self.CHUNK_FLAG)
+        tree = {}
+        for obj in entries:
+            if not obj.get('Flags', 0) & self.CHUNK_FLAG:
+                tree[obj['Key']] = self._decode_entry(obj, chunks)
+        return tree
+
+    def _decode_entry(self, obj, chunks=None):
+        """Returns the value, flags and ModifyIndex of a raw entry with
+        compressed values decompressed and sharded values assembled from
+        their chunks"""
+        flags = obj.get('Flags', 0)
+        value = self._plain_value(obj['Key'], base64.b64decode(obj.get('Value') or ''), flags, chunks)
+        return dict(value=value, flags=flags, modify_index=obj.get('ModifyIndex'))
+
+    def _plain_value(self, key, value, flags, chunks=None):
+        if flags & self.MANIFEST_FLAG:
+            return self._assemble_manifest(key, value, chunks or {})
+        if flags & self.COMPRESSED_FLAG:
+            return zlib.decompress(value)
+        return value
+
+    def _differs(self, current, value, flags):
+        if current is None:
+            return True
+        # Sharding is decided by the size of the value so it is not compared
+        stored_flags = current['flags'] & ~self.MANIFEST_FLAG
+        return current['value'] != self._encode_value(value) or stored_flags != self._stored_flags(flags)
+
+    def _stored_value(self, value):
+        value = self._encode_value(value)
+        if self.compress:
+            value = zlib.compress(value)
+        return value
+
+    def _stored_flags(self, flags):
+        flags = int(flags or 0)
+        if self.compress:
+            flags |= self.COMPRESSED_FLAG
+        return flags
+
+    def _compress_value(self):
+        self.body = self._stored_value(self.value)
+        self.flags = self._stored_flags(self.flags)
+        if len(self.body) > self.MAX_VALUE_BYTES:
+            self._put_sharded()
+
+    def _put_raw(self, key, data, flags, cas=None):
+        params = self._base_query_params()
+        if flags:
+            params['flags'] = flags
+        if cas is not None:
+            params['cas'] = cas
+        code, body, info = self._api_request(self._kv_url(key, params), data=data, method='PUT')
+        if code != 200 or body != 'true':
+            self.module.fail_json(msg="Failed PUT with a %i for key: %s because %s" % (code, key, body))
+
+    def _chunk_prefix(self, key, generation):
+        return '%s%s%s/' % (key, self.CHUNK_SUFFIX, generation)
+
+    def _put_sharded(self):
+        """Writes a compressed value over the size limit as chunk keys and
+        then the manifest, so readers only see the new chunks once they are
+        all written. Chunks are keyed by a content hash and earlier ones
+        are removed after the manifest is updated"""
+        generation = hashlib.sha1(self.body).hexdigest()[:12]
+        chunk_prefix = self._chunk_prefix(self.key, generation)
+        size = self.MAX_VALUE_BYTES
+        count = (len(self.body) + size - 1) / size
+        for n in range(count):
+            self._put_raw(chunk_prefix + '%06d' % n, self.body[n * size:(n + 1) * size], self.CHUNK_FLAG)
+        manifest = json.dumps(OrderedDict([('generation', generation), ('chunks', count), ('size', len(self.body))]))
+        self._put_raw(self.key, manifest, self.flags | self.MANIFEST_FLAG, cas=self.cas)
+        self._delete_chunks(self.key, keep=chunk_prefix)
+        self.module.exit_json(changed=True, succeeded=True, key=self.key, value=self.value, chunks=count)
+
+    def _delete_chunks(self, key, keep=None):
+        """Deletes the chunks of earlier sharded values of key, listing
+        them first as reads are cheaper than the writes"""
+        params = self._base_query_params()
+        params['keys'] = 'true'
+        params['separator'] = '/'
+        code, body, info = self._api_request(self._kv_url(key + self.CHUNK_SUFFIX, params))
+        if code == 200:
+            for stale in json.loads(body):
+                if stale != keep:
+                    params = self._base_query_params()
+                    params['recurse'] = 'true'
+                    self._api_request(self._kv_url(stale, params), method='DELETE')
+
+    def _read_chunks(self, chunk_prefix):
+        params = self._read_params()
+        params['recurse'] = 'true'
+        code, body, info = self._api_request(self._kv_url(chunk_prefix, params))
+        if code != 200:
+            self.module.fail_json(msg="Failed reading chunks %s with a %i because %s" % (chunk_prefix, code, body))
+        self._read_metadata(info)
+        return dict((obj['Key'], base64.b64decode(obj.get('Value') or '')) for obj in json.loads(body))
+
+    def _assemble_manifest(self, key, manifest, chunks):
+        """Returns the decompressed value of a manifest, reading its chunks
+        when they are not among the entries already read"""
+        manifest = json.loads(manifest)
+        chunk_prefix = self._chunk_prefix(key, manifest['generation'])
+        names = [chunk_prefix + '%06d' % n for n in range(manifest['chunks'])]
+        if not all(name in chunks for name in names):
+            chunks = self._read_chunks(chunk_prefix)
+        return zlib.decompress(''.join(chunks[name] for name in names))
+
+    def _assemble_shards(self, entries):
+        """Replaces manifests with their decompressed values and drops the
+        chunk entries a recursive GET returns alongside them"""
+        chunks = dict((name, chunk['Value']) for name, chunk in self.chunks.iteritems())
+        for key, entry in self.manifests:
+            entry['Value'] = self._plain_value(key, entry['Value'], self.MANIFEST_FLAG, chunks)
+        chunk_ids = set(id(entry) for entry in self.chunks.values())
+        return [entry for entry in entries if id(entry) not in chunk_ids]
+
+    def _exit_if_unchanged(self):
+        current = self._read_key(self.key)
+        if not self._differs(current, self.value, self.flags):
+            self.module.exit_json(changed=False, succeeded=True, key=self.key, value=self.value)
+
+    def _changed_items(self):
+        """Compares items against the stored tree under their common prefix
+        and returns the items to write along with a diff"""
+        keys = [self._item_key(item) for item in self.items]
+        tree = self._read_tree(os.path.commonprefix(keys))
+        changed, before, after = [], OrderedDict({}), OrderedDict({})
+        for key, item in zip(keys, self.items):
+            current = tree.get(key)
+            if self._differs(current, item['value'], item.get('flags')):
+                changed.append(item)
+                if current is not None:
+                    before[key] = current['value']
+                after[key] = self._encode_value(item['value'])
+        return changed, dict(before=before, after=after)
+
+    def _put_items(self):
+        items, diff = self.items, None
+        if self.compare:
+            items, diff = self._changed_items()
+        results = self._run_txn([self._txn_set_op(item) for item in items])
+        failed = [r['key'] for r in results if not r['succeeded']]
+        if failed:
+            self.module.fail_json(msg="Failed PUT for %i of %i items" % (len(failed), len(results)),
+                                  failed_keys=failed, results=results)
+        result = dict(changed=bool(results), succeeded=True, key=self.key, results=results)
+        if diff is not None:
+            result['diff'] = diff
+            result['unchanged'] = len(self.items) - len(items)
+        self.module.exit_json(**result)
+
+    def _wait_satisfied(self, entry):
+        if entry is None:
+            return False
+        if self.wait_for == self.VALUE:
+            return entry['Value'] == self._encode_value(self.value)
+        if self.wait_for == self.MODIFIED:
+            return entry['ModifyIndex'] > self.index
+        return True
+
+    def _wait_for_key(self):
+        """Long-polls the key with blocking queries until the wait_for
+        condition holds or the timeout passes"""
+        deadline = time.time() + self.timeout
+        max_wait = self._duration_seconds(self.wait or self.DEFAULT_WAIT)
+        index = self.index or 0
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                self.module.fail_json(msg="Timed out after %is waiting for %s on key: %s" % (self.timeout, self.wait_for, self.key),
+                                      key=self.key, index=index)
+            wait = '%ds' % max(1, int(min(max_wait, remaining)))
+            params = self._read_params()
+            params['index'] = index
+            params['wait'] = wait
+            code, body, info = self._api_request(self._url_with_params(self.api_url, params),
+                                                 timeout=self._request_timeout(wait))
+            if code == 200:
+                entry = json.loads(body)[0]
+                entry['Value'] = self._decode_entry(entry)['value']
+                entry['Flags'] = entry.get('Flags', 0) & ~self.MARKER_FLAGS
+            elif code == 404:
+                entry = None
+            else:
+                self.module.fail_json(msg="Failed waiting with a %i for key: %s because %s" % (code, self.key, body))
+            new_index = int(info.get('x-consul-index') or 0)
+            if self._wait_satisfied(entry):
+                self.module.exit_json(changed=False, succeeded=True, key=self.key, value=[entry], index=new_index,
+                                      **self._read_metadata(info))
+            # Reset when the index goes backwards, ie after a snapshot restore
+            index = new_index if new_index >= index else 0
+
+    def _walk_keys(self, prefix, max_depth=None):
+        """Yields every key under prefix by listing one separator level at
+        a time, so only the levels being walked are held in memory. Below
+        max_depth levels the folders are yielded instead of expanded"""
+        separator = self.separator or '/'
+        pending = collections.deque([(prefix, 0)])
+        while pending:
+            current, depth = pending.popleft()
+            params = self._read_params()
+            params['keys'] = 'true'
+            params['separator'] = separator
+            code, body, info = self._api_request(self._kv_url(current, params))
+            if code == 404:
+                continue
+            if code != 200:
+                self.module.fail_json(msg="Failed listing %s with a %i because %s" % (current, code, body))
+            self._read_metadata(info)
+            for child in json.loads(body):
+                if child.endswith(separator) and child != current and (max_depth is None or depth < max_depth):
+                    pending.append((child, depth + 1))
+                else:
+                    yield child
+
+    def _included(self, key):
+        if not self.include:
+            return True
+        if self.match == self.REGEX:
+            return any(re.search(pattern, key) for pattern in self.include)
+        return any(fnmatch.fnmatchcase(key, pattern) for pattern in self.include)
+
+    def _walk(self):
+        """Lists keys under the prefix one level at a time, stopping once
+        limit keys matched so only the needed parts are transferred"""
+        keys = []
+        truncated = False
+        for key in self._walk_keys(self.key, self.depth):
+            if not self._included(key):
+                continue
+            if self.limit is not None and len(keys) >= self.limit:
+                truncated = True
+                break
+            keys.append(key)
+        self.module.exit_json(changed=False, succeeded=True, key=self.key, value=keys, truncated=truncated)
+
+    def _pages(self, iterable, size):
+        iterator = iter(iterable)
+        while True:
+            page = list(itertools.islice(iterator, size))
+            if not page:
+                return
+            yield page
+
+    def _get_page(self, keys):
+        """Reads the entries for a page of keys in one read-only transaction,
+        which takes the same consistency modes as a GET"""
+        ops = [{'KV': OrderedDict([('Verb', 'get'), ('Key', key)])} for key in keys]
+        url = self._url_with_params(self.txn_url, self._read_params())
+        code, body, info = self._api_request(url, data=json.dumps(ops), method='PUT')
+        if code == 409:
+            # A key deleted since it was listed fails the whole transaction
+            missing = set(e['OpIndex'] for e in json.loads(body).get('Errors') or [])
+            if not missing:
+                self.module.fail_json(msg="Failed reading keys because %s" % body)
+            keys = [key for i, key in enumerate(keys) if i not in missing]
+            return self._get_page(keys) if keys else []
+        if code != 200:
+            self.module.fail_json(msg="Failed reading keys with a %i because %s" % (code, body))
+        self._read_metadata(info)
+        return [r['KV'] for r in json.loads(body).get('Results') or [] if r.get('KV')]
+
+    def _open(self, path, mode):
+        if self.gzip:
+            return gzip.open(path, mode)
+        return open(path, mode)
+
+    def _export(self):
+        """Streams every entry under the key prefix to path, one JSON entry
+        per line, reading page_size keys per transaction"""
+        exported = 0
+        tmp_path = self.path + '.tmp'
+        out = self._open(tmp_path, 'wb')
+        try:
+            for page in self._pages(self._walk_keys(self.key), self.page_size):
+                for entry in self._get_page(page):
+                    line = OrderedDict([('Key', entry['Key']), ('Flags', entry.get('Flags', 0)), ('Value', entry.get('Value'))])
+                    out.write(json.dumps(line) + '\n')
+                    exported += 1
+        finally:
+            out.close()
+        os.rename(tmp_path, self.path)
+        self.module.exit_json(changed=True, succeeded=True, key=self.key, path=self.path, exported=exported)
+
+    def _subtree(self, key, depth):
+        # Keys are counted under their folder, leaf keys above depth under
+        # their parent so a flat prefix is a single subtree
+        separator = self.separator or '/'
+        folders = key[len(self.key):].split(separator)[:-1]
+        return self.key + ''.join(folder + separator for folder in folders[:depth])
+
+    def _value_size(self, value):
+        # Base64 decodes to 3 bytes for every 4 characters less padding
+        if not value:
+            return 0
+        return len(value) * 3 / 4 - value[-2:].count('=')
+
+    def _add_usage(self, usage, key, size, flags, modify_index):
+        usage['keys'] += 1
+        usage['total_bytes'] += size
+        if size > usage['max_bytes'] or usage['max_key'] is None:
+            usage['max_bytes'], usage['max_key'] = size, key
+        usage['flags'][flags] = usage['flags'].get(flags, 0) + 1
+        if usage['oldest_index'] is None or modify_index < usage['oldest_index']:
+            usage['oldest_index'], usage['oldest_key'] = modify_index, key
+        if usage['newest_index'] is None or modify_index > usage['newest_index']:
+            usage['newest_index'], usage['newest_key'] = modify_index, key
+
+    def _new_usage(self):
+        return OrderedDict([('keys', 0), ('total_bytes', 0), ('max_bytes', 0), ('max_key', None), ('flags', {}),
+                            ('oldest_index', None), ('oldest_key', None),
+                            ('newest_index', None), ('newest_key', None)])
+
+    def _analyze(self):
+        """Reports usage per subtree in one pass over the prefix, reading
+        page_size keys per transaction and only keeping the totals and the
+        top largest keys in memory"""
+        depth = 1 if self.depth is None else self.depth
+        total = self._new_usage()
+        subtrees = {}
+        largest = []
+        for page in self._pages(self._walk_keys(self.key), self.page_size):
+            for entry in self._get_page(page):
+                key, flags, modify_index = entry['Key'], entry.get('Flags', 0), entry.get('ModifyIndex')
+                size = self._value_size(entry.get('Value'))
+                subtree = self._subtree(key, depth)
+                if subtree not in subtrees:
+                    subtrees[subtree] = self._new_usage()
+                self._add_usage(subtrees[subtree], key, size, flags, modify_index)
+                self._add_usage(total, key, size, flags, modify_index)
+                if len(largest) < self.top:
+                    heapq.heappush(largest, (size, key))
+                elif size > largest[0][0]:
+                    heapq.heapreplace(largest, (size, key))
+        self.module.exit_json(changed=False, succeeded=True, key=self.key, total=total,
+                              subtrees=OrderedDict(sorted(subtrees.items())),
+                              largest=[dict(key=key, bytes=size) for size, key in sorted(largest, reverse=True)])
+
+    def _read_key(self, key):
+        """Reads a single key returning its decompressed value, flags and
+        ModifyIndex, or None when it does not exist"""
+        code, body, info = self._api_request(self._kv_url(key, self._read_params()))
+        if code == 404:
+            return None
+        if code != 200:
+            self.module.fail_json(msg="Failed GET with a %i for key: %s because %s" % (code, key, body))
+        self._read_metadata(info)
+        return self._decode_entry(json.loads(body)[0])
+
+    def _merge_patch(self, target, patch):
+        """Applies a JSON merge patch as described in RFC 7386"""
+        if not isinstance(patch, dict):
+            return patch
+        if not isinstance(target, dict):
+            target = OrderedDict({})
+        for name, value in patch.iteritems():
+            if value is None:
+                target.pop(name, None)
+            else:
+                target[name] = self._merge_patch(target.get(name), value)
+        return target
+
+    def _sleep_backoff(self, attempt):
+        # Full jitter spreads out writers that collided on the same index
+        time.sleep(random.uniform(0, min(self.MAX_BACKOFF, self.backoff * 2 ** attempt)))
+
+    def _patch(self):
+        """Reads the JSON value, applies the patch and writes it back with
+        check and set on the ModifyIndex read, retrying with backoff when
+        another writer got there first"""
+        for attempt in range(self.retries + 1):
+            current = self._read_key(self.key)
+            before = OrderedDict({})
+            if current is not None and current['value'].strip():
+                try:
+                    before = json.loads(current['value'], object_pairs_hook=OrderedDict)
+                except ValueError, e:
+                    self.module.fail_json(msg="Value of key: %s is not valid JSON: %s" % (self.key, str(e)))
+            after = self._merge_patch(copy.deepcopy(before), self.patch)
+            if after == before:
+                self.module.exit_json(changed=False, succeeded=True, key=self.key, value=after, attempts=attempt + 1)
+            flags = self.flags
+            if flags is None and current is not None:
+                flags = current['flags'] & ~self.MARKER_FLAGS
+            params = self._base_query_params()
+            params['cas'] = current['modify_index'] if current else 0
+            flags = self._stored_flags(flags)
+            if flags:
+                params['flags'] = flags
+            code, body, info = self._api_request(self._kv_url(self.key, params), data=self._stored_value(after), method='PUT')
+            if code == 200 and body == 'true':
+                self.module.exit_json(changed=True, succeeded=True, key=self.key, value=after, attempts=attempt + 1,
+                                      diff=dict(before=before, after=after))
+            if code != 200:
+                self.module.fail_json(msg="Failed PATCH with a %i for key: %s because %s" % (code, self.key, body))
+            if attempt < self.retries:
+                self._sleep_backoff(attempt)
+        self.module.fail_json(msg="Failed PATCH for key: %s after %i attempts because of concurrent writes" % (self.key, self.retries + 1))
+
+    def _checkpoint_path(self):
+        return self.checkpoint or self.path + '.checkpoint'
+
+    def _read_checkpoint(self):
+        try:
+            with open(self._checkpoint_path()) as checkpoint:
+                return int(json.load(checkpoint)['line'])
+        except IOError:
+            return 0
+
+    def _write_checkpoint(self, line):
+        tmp_path = self._checkpoint_path() + '.tmp'
+        with open(tmp_path, 'w') as checkpoint:
+            json.dump(dict(path=self.path, line=line), checkpoint)
+        os.rename(tmp_path, self._checkpoint_path())
+
+    def _import_ops(self, source, line, lines):
+        """Yields a set op per entry line after the checkpoint, appending
+        the line number of each op to lines"""
+        for raw in itertools.islice(source, line, None):
+            line += 1
+            if not raw.strip():
+                continue
+            entry = json.loads(raw)
+            op = OrderedDict([('Verb', 'set'), ('Key', entry['Key']), ('Flags', entry.get('Flags', 0))])
+            if entry.get('Value') is not None:
+                op['Value'] = entry['Value']
+            lines.append(line)
+            yield {'KV': op}
+
+    def _import(self):
+        """Writes the entries in path with chunked transactions, recording
+        the last committed line so a failed import can be resumed"""
+        start = line = self._read_checkpoint()
+        imported = 0
+        lines = []
+        source = self._open(self.path, 'rb')
+        try:
+            for chunk in self._txn_chunks(self._import_ops(source, line, lines)):
+                results = self._apply_txn(chunk)
+                failed = [r for r in results if not r['succeeded']]
+                if failed:
+                    self.module.fail_json(msg="Failed importing %s after line %i because %s" % (self.path, line, failed[0]['error']),
+                                          imported=imported, checkpoint=self._checkpoint_path(), line=line)
+                imported += len(chunk)
+                # The chunker reads one op past the chunk it yields so the
+                # committed line is the last one belonging to this chunk
+                line = lines[len(chunk) - 1]
+                del lines[:len(chunk)]
+                self._write_checkpoint(line)
+        finally:
+            source.close()
+        if os.path.exists(self._checkpoint_path()):
+            os.remove(self._checkpoint_path())
+        self.module.exit_json(changed=imported > 0, succeeded=True, path=self.path, imported=imported,
+                              resumed_from=start)
+
+    def _multiple_datacenters(self):
+        return len(self.datacenters) > 1 or self.datacenters[0] == self.ALL_DATACENTERS
+
+    def _all_datacenters(self):
+        params = OrderedDict({})
+        if self.token:
+            params['token'] = self.token
+        url = self._url_with_params("http://%s:%s/%s/catalog/datacenters" % (self.host, self.port, self.version), params)
+        code, body, info = self._api_request(url)
+        if code != 200:
+            self.module.fail_json(msg="Failed listing datacenters with a %i because %s" % (code, body))
+        return json.loads(body)
+
+    def _write_datacenter(self, dc):
+        """Runs the action against one datacenter on a copy of this object
+        and returns whether it failed with its result"""
+        consulkv = copy.copy(self)
+        consulkv.module = DatacenterModule(self.module)
+        consulkv.dc = dc
+        consulkv._build_url()
+        try:
+            consulkv._run_action()
+        except DatacenterExit, e:
+            return dc, e.failed, e.result
+        except Exception, e:
+            return dc, True, dict(msg=str(e))
+        return dc, True, dict(msg='No result')
+
+    def _write_datacenters(self):
+        datacenters = self.datacenters
+        if self.dc == self.ALL_DATACENTERS:
+            datacenters = self._all_datacenters()
+        pool = ThreadPool(max(1, min(self.concurrency, len(datacenters))))
+        try:
+            written = pool.map(self._write_datacenter, datacenters)
+        finally:
+            pool.close()
+        results = OrderedDict((dc, result) for dc, failed, result in written)
+        failed = [dc for dc, dc_failed, result in written if dc_failed]
+        changed = any(result.get('changed') for dc, dc_failed, result in written if not dc_failed)
+        if failed:
+            self.module.fail_json(msg="Failed %s for key: %s in %s" % (self.action, self.key, ', '.join(failed)),
+                                  changed=changed, failed_datacenters=failed, datacenters=results)
+        self.module.exit_json(changed=changed, succeeded=True, key=self.key, datacenters=results)
+
+    def _is_folder(self, key, current):
+        return key.endswith('/') and not current['value']
+
+    def _sync_ops(self, tree):
+        """Computes the minimal set of ops to make the prefix hold exactly
+        the items. Every op is guarded by the ModifyIndex that was read so
+        concurrent writers make the transaction fail instead of being
+        overwritten"""
+        ops, before, after = [], OrderedDict({}), OrderedDict({})
+        desired = set()
+        for item in self.items:
+            key = self._item_key(item)
+            desired.add(key)
+            current = tree.get(key)
+            if not self._differs(current, item['value'], item.get('flags')):
+                continue
+            op = self._txn_set_op(item)
+            op['KV']['Verb'] = 'cas'
+            op['KV']['Index'] = current['modify_index'] if current else 0
+            ops.append(op)
+            ops += self._delete_chunks_ops(key, current)
+            if current is not None:
+                before[key] = current['value']
+            after[key] = self._encode_value(item['value'])
+        for key in sorted(set(tree) - desired):
+            if self._is_folder(key, tree[key]):
+                continue
+            op = OrderedDict({})
+            op['Verb'] = 'delete-cas'
+            op['Key'] = key
+            op['Index'] = tree[key]['modify_index']
+            ops.append({'KV': op})
+            ops += self._delete_chunks_ops(key, tree[key])
+            before[key] = tree[key]['value']
+        return ops, dict(before=before, after=after)
+
+    def _delete_chunks_ops(self, key, current):
+        """Returns the op removing the chunks of a sharded value that is
+        being deleted or replaced, as they are not part of the tree"""
+        if current is None or not current['flags'] & self.MANIFEST_FLAG:
+            return []
+        return [{'KV': OrderedDict([('Verb', 'delete-tree'), ('Key', key + self.CHUNK_SUFFIX)])}]
+
+    def _sync_items(self):
+        tree = self._read_tree(self.key)
+        ops, diff = self._sync_ops(tree)
+        results = self._run_txn(ops)
+        failed = [r['key'] for r in results if not r['succeeded']]
+        if failed:
+            self.module.fail_json(msg="Failed to sync %i of %i changes under %s, keys may have been modified concurrently" % (len(failed), len(results), self.key),
+                                  failed_keys=failed, results=results)
+        self.module.exit_json(changed=bool(results), succeeded=True, key=self.key, results=results, diff=diff,
+                              created=len([r for r in results if r['verb'] == 'cas' and r['key'] not in tree]),
+                              updated=len([r for r in results if r['verb'] == 'cas' and r['key'] in tree]),
+                              deleted=len([r for r in results if r['verb'] == 'delete-cas']))
+
+    def _project_entry(self, obj):
+        key, flags = obj.get('Key'), obj.get('Flags', 0)
+        if self.fields:
+            obj = dict((field, obj[field]) for field in self.fields if field in obj)
+        if self.decode and 'Value' in obj:
+            obj['Value'] = self._decode_value(obj['Value'])
+            if obj['Value'] is not None:
+                if flags & self.CHUNK_FLAG:
+                    self.chunks[key] = obj
+                elif flags & self.MANIFEST_FLAG:
+                    self.manifests.append((key, obj))
+                else:
+                    obj['Value'] = self._plain_value(key, obj['Value'], flags)
+            if 'Flags' in obj:
+                obj['Flags'] = flags & ~self.MARKER_FLAGS
+        return obj
+
+    def _decode_value(self, value):
+        if value is None:
+            return ''
+        if self.max_decoded_bytes is not None:
+            size = self._value_size(value)
+            if self.decoded_bytes + size > self.max_decoded_bytes:
+                self.truncated += 1
+                return None
+            self.decoded_bytes += size
+        return base64.b64decode(value)
+
     def _handle_response(self, response, response_body):
+        if self.action in [self.PUT, self.DELETE] and response_body == 'true' and not self.recurse:
+            # A value that is no longer sharded leaves its chunks behind, a
+            # recursive DELETE already removes them with the key prefix
+            self._delete_chunks(self.key)
         if self.action == self.PUT and response_body == 'true':
             self.module.exit_json(changed=True, succeeded=True, key=self.key, value=self.value)
         elif self.action == self.DELETE and response.getcode() == 200:
             self.module.exit_json(changed=True, succeeded=True, key=self.key, deleted=True)
         elif self.action == self.GET:
-            parsed_response = json.loads(response_body)
-            # Decode values
-            for obj in parsed_response:
-                # When doing a GET for only keys the objects will not
-                # be a dict with metadata but only a list of string key values
-                if isinstance(obj, dict):
-                    obj['Value'] = base64.decodestring(obj.get('Value', ''))
-            self.module.exit_json(changed=True, succeeded=True, key=self.key, value=parsed_response)
+            # Entries are projected and decoded as they are parsed so only
+            # one copy of a large recursive response is built.
+            # When doing a GET for only keys the response is a list of
+            # string key values and the hook is never called
+            parsed_response = json.loads(response_body, object_hook=self._project_entry)
+            if self.manifests or self.chunks:
+                parsed_response = self._assemble_shards(parsed_response)
+            result = dict(changed=True, succeeded=True, key=self.key, value=parsed_response,
+                          index=int(self.info.get('x-consul-index') or 0))
+            if self.max_decoded_bytes is not None:
+                result.update(decoded_bytes=self.decoded_bytes, truncated=self.truncated)
+            result.update(self._read_metadata(self.info))
+            self.module.exit_json(**result)
         else:
             self.module.fail_json(msg="Failed %s with a %i for key: %s because %s" % (self.action, response.getcode(), self.key, response_body))
 
@@ -268,19 +1464,46 @@ def main():
         argument_spec=dict(
             acquire=dict(require=False),
             action=dict(required=True),
+            backoff=dict(required=False, default=0.1, type='float'),
             cas=dict(require=False, type='int'),
-            dc=dict(required=False, default='dc1'),
+            checkpoint=dict(required=False),
+            compare=dict(required=False, default=False, type='bool'),
+            compress=dict(required=False, default=False, type='bool'),
+            concurrency=dict(required=False, default=8, type='int'),
+            consistency=dict(required=False, default='default', choices=['default', 'stale', 'consistent']),
+            dc=dict(required=False, default=['dc1'], type='list'),
+            depth=dict(required=False, type='int'),
+            decode=dict(required=False, default=True, type='bool'),
+            fields=dict(required=False, type='list'),
             flags=dict(require=False, type='int'),
+            gzip=dict(required=False, default=False, type='bool'),
             host=dict(required=False, default="127.0.0.1"),
-            key=dict(required=True),
+            include=dict(required=False, type='list'),
+            index=dict(required=False, type='int'),
+            items=dict(required=False, type='list'),
+            key=dict(required=False),
             keys=dict(require=False, default=False, type='bool'),
+            limit=dict(required=False, type='int'),
+            match=dict(required=False, default='glob', choices=['glob', 'regex']),
+            max_decoded_bytes=dict(required=False, type='int'),
+            max_stale=dict(required=False),
+            page_size=dict(required=False, default=ConsulKV.TXN_MAX_OPS, type='int'),
+            patch=dict(required=False, type='raw'),
+            path=dict(required=False),
             port=dict(require=False, default=8500),
             recurse=dict(require=False, default=False, type='bool'),
             release=dict(require=False),
+            retries=dict(required=False, default=10, type='int'),
             separator=dict(require=False),
+            state=dict(required=False, choices=['synced']),
+            timeout=dict(required=False, default=300, type='int'),
             token=dict(required=False, default=None),
+            top=dict(required=False, default=10, type='int'),
             value=dict(required=False),
             version=dict(required=False, default='v1'),
+            wait=dict(required=False),
+            wait_for=dict(required=False, choices=['exists', 'value', 'modified']),
+            walk=dict(required=False, default=False, type='bool'),
         ),
         supports_check_mode=True
     )
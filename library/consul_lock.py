@@ -0,0 +1,614 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+
+# Copyright 2015 Chavez <chavez@somewhere-cool.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+import base64
+import json
+import re
+import string
+import time
+import urllib
+
+from collections import OrderedDict
+
+
+DOCUMENTATION = '''
+---
+module: consul_lock
+version_added: "1.9"
+author: Chavez
+short_description: Distributed locks with Consul sessions and K/V acquire
+description:
+   - Acquire and release a lock on a Consul key. Acquire creates a session,
+     unless one is given, and waits for the lock with blocking queries.
+   - With a limit the key is a semaphore prefix that up to limit sessions
+     can hold at once. Each session writes a contender key under the prefix
+     and joins the holders of a check and set guarded .lock document, which
+     drops holders whose sessions are gone.
+   - elect campaigns for leadership of the key with a single acquire and
+     reports the leader, the value stored by its holder. Followers do not
+     keep their session. Without a session given, a candidate whose value
+     is held by a session of its node under the same name is still the
+     leader and keeps that session on the next run.
+options:
+  action:
+    description:
+      - Lock action [acquire, release, elect]
+    required: true
+  behavior:
+    description:
+      - Controls when the session is invalidated [release, delete]
+    required: false
+    default: release
+  checks:
+    description:
+      - List of associated health checks comma separated "foo,bar,baz"
+    required: false
+    default: serfHealth
+  dc:
+    desription:
+      - The datacenter to use
+    required: false
+    default: dc1
+  destroy_session:
+    description:
+      - Destroy the session after releasing the lock
+    required: false
+    default: True
+  host:
+    description:
+      - Consul host
+    required: true
+    default: 127.0.0.1
+  key:
+    description:
+      - Key to lock
+    required: true
+  limit:
+    description:
+      - Hold a semaphore on the key prefix with this many slots instead of
+        a lock. Every contender must use the same limit.
+    required: false
+  lock_delay:
+    description:
+      - Time the lock can not be acquired after its session is invalidated,
+        also how long to wait before acquiring a lock released that way
+    required: false
+    default: 15s
+  name:
+    description:
+      - Name of the session created for the lock. Elect defaults it to
+        consul_lock elect <key> to find its session again on later runs.
+    required: false
+  node:
+    description:
+      - Node name to set on the session, elect looks up the agent's node
+        name when not given
+    required: false
+  port:
+    description:
+      - Consul API port
+    required: true
+  session:
+    description:
+      - Session to acquire with instead of creating one, required to release
+    required: false
+  timeout:
+    description:
+      - Seconds to wait for the lock before failing
+    required: false
+    default: 300
+  token:
+    description:
+      - ACL token to use with requests
+    required: false
+  ttl:
+    description:
+      - Session TTL. Without one the session lives until it is destroyed or
+        its checks fail.
+    required: false
+  value:
+    description:
+      - Value to store in the key, or contender key with a limit, while
+        holding the lock
+    required: false
+  version:
+    description:
+      - Consul API version
+    required: true
+    default: v1
+  wait:
+    description:
+      - Max duration of each blocking query while waiting, ie 30s
+    required: false
+    default: 30s
+  wait_for_change:
+    description:
+      - On elect, block until the leader changes or timeout passes. A
+        follower campaigns again when the leadership is free.
+    required: false
+    default: False
+
+# informational: requirements for nodes
+requirements: []
+'''
+
+EXAMPLES = '''
+- name: Acquire the migration lock
+  consul_lock:
+    action: acquire
+    key: locks/db-migration
+    value: "{{ inventory_hostname }}"
+    timeout: 600
+  register: migration_lock
+
+- name: Release the migration lock
+  consul_lock:
+    action: release
+    key: locks/db-migration
+    session: "{{ migration_lock.session }}"
+
+- name: Restart with at most 3 hosts at once across all plays
+  consul_lock:
+    action: acquire
+    key: semaphores/app-restart
+    limit: 3
+    value: "{{ inventory_hostname }}"
+  register: restart_slot
+
+- name: Give back the restart slot
+  consul_lock:
+    action: release
+    key: semaphores/app-restart
+    limit: 3
+    session: "{{ restart_slot.session }}"
+
+- name: Elect the host running the nightly job
+  consul_lock:
+    action: elect
+    key: service/nightly/leader
+    value: "{{ inventory_hostname }}"
+    ttl: 60s
+  register: election
+
+- name: Wait for the leader to change
+  consul_lock:
+    action: elect
+    key: service/nightly/leader
+    value: "{{ inventory_hostname }}"
+    wait_for_change: True
+    timeout: 3600
+  when: not election.is_leader
+'''
+
+#
+# Module execution.
+#
+
+
+class ConsulLock(object):
+
+    ALLOWED_ACTIONS = ['acquire', 'release', 'elect']
+    ACQUIRE, RELEASE, ELECT = ALLOWED_ACTIONS
+
+    DEFAULT_CHECKS = ['serfHealth']
+    ELECTION_NAME = 'consul_lock elect %s'
+    SEMAPHORE_LOCK = '.lock'
+
+    def __init__(self, module):
+        """Takes an AnsibleModule object to set up Consul lock interaction"""
+        self.module = module
+        self.action = string.lower(module.params.get('action', ''))
+        self.behavior = module.params.get('behavior', 'release')
+        self.checks = module.params.get('checks', self.DEFAULT_CHECKS[0])
+        self.dc = module.params.get('dc', 'dc1')
+        self.destroy_session = module.params.get('destroy_session', True)
+        self.host = module.params.get('host', '127.0.0.1')
+        self.key = module.params.get('key', '')
+        self.limit = module.params.get('limit', None)
+        self.lock_delay = module.params.get('lock_delay', '15s')
+        self.name = module.params.get('name', None)
+        self.node = module.params.get('node', None)
+        self.port = module.params.get('port', 8500)
+        self.session = module.params.get('session', None)
+        self.timeout = module.params.get('timeout', 300)
+        self.token = module.params.get('token', None)
+        self.ttl = module.params.get('ttl', None)
+        self.value = module.params.get('value', None) or ''
+        self.version = module.params.get('version', 'v1')
+        self.wait = module.params.get('wait', '30s')
+        self.wait_for_change = module.params.get('wait_for_change', False)
+        self.params = OrderedDict({})
+        self.checks = str(self.checks).split(',')
+        self.created_session = False
+        if self.limit:
+            self.key = self.key.rstrip('/')
+        if self.action == self.ELECT and not self.name:
+            self.name = self.ELECTION_NAME % self.key
+
+    def run_cmd(self):
+        self.validate()
+        # ie self._acquire(), self._release(), self._elect()
+        getattr(self, "_%s" % self.action)()
+
+    def validate(self):
+        # Check action is allowed
+        if not self.action or self.action not in self.ALLOWED_ACTIONS:
+            self.module.fail_json(msg='Action is required and must be one of %r' % self.ALLOWED_ACTIONS)
+        if not self.key:
+            self.module.fail_json(msg='A key is required to lock')
+        if self.limit is not None and self.limit < 1:
+            self.module.fail_json(msg='Limit must be at least 1')
+        # Validate action being used
+        # ie self._validate_acquire(), self._validate_release(), self._validate_elect()
+        getattr(self, "_validate_%s" % self.action)()
+
+    def _validate_acquire(self):
+        pass
+
+    def _validate_elect(self):
+        if self.limit:
+            self.module.fail_json(msg='Elect does not take a limit')
+
+    def _validate_release(self):
+        if not self.session:
+            self.module.fail_json(msg='Release requires the session holding the lock')
+
+    def _url(self, path, params=None):
+        url = "http://%s:%s/%s/%s" % (self.host, self.port, self.version, path)
+        params = urllib.urlencode(params or self._query_params())
+        if params:
+            url = url + '?' + params
+        return url
+
+    def _query_params(self):
+        params = OrderedDict({})
+        if self.dc != 'dc1':
+            params['dc'] = self.dc
+        if self.token:
+            params['token'] = self.token
+        return params
+
+    def _duration_seconds(self, duration):
+        """Converts a Consul duration like 500ms, 30s or 1m30s to seconds,
+        a bare number is taken as seconds"""
+        units = {'ns': 1e-9, 'us': 1e-6, 'ms': 1e-3, 's': 1, 'm': 60, 'h': 3600}
+        duration = str(duration).strip()
+        if re.match(r'^\d+(?:\.\d+)?$', duration):
+            return float(duration)
+        if not re.match(r'^(?:\d+(?:\.\d+)?(?:ns|us|ms|s|m|h))+$', duration):
+            self.module.fail_json(msg='Invalid duration %s' % duration)
+        return sum(float(number) * units[unit]
+                   for number, unit in re.findall(r'(\d+(?:\.\d+)?)(ns|us|ms|s|m|h)', duration))
+
+    def _api_request(self, url, data=None, method='GET', timeout=10):
+        """Makes a request and returns the status code, body and info"""
+        (response, info) = fetch_url(self.module, url, data=data, method=method, timeout=timeout)
+        if response is None:
+            return info.get('status', -1), info.get('body', info.get('msg', '')), info
+        return response.getcode(), response.read(), info
+
+    def _add_create_params(self):
+        valid_params = {
+            "lock_delay": "LockDelay",
+            "name": "Name",
+            "node": "Node",
+            "checks": "Checks",
+            "behavior": "Behavior",
+            "ttl": "TTL"
+        }
+        for param, name in valid_params.iteritems():
+            if hasattr(self, param) and getattr(self, param):
+                self.params[name] = getattr(self, param)
+        # Ensure the default checks exist
+        if self.DEFAULT_CHECKS[0] not in self.params['Checks']:
+            self.params['Checks'] += self.DEFAULT_CHECKS
+        self.params['Checks'] = filter(None, self.params['Checks'])
+
+    def _create_session(self):
+        self._add_create_params()
+        code, body, info = self._api_request(self._url('session/create'), data=json.dumps(self.params), method='PUT')
+        if code != 200:
+            self.module.fail_json(msg="Failed creating session with code %i and response %s" % (code, body))
+        self.session = json.loads(body)['ID']
+        self.created_session = True
+
+    def _destroy_session(self):
+        code, body, info = self._api_request(self._url('session/destroy/%s' % self.session), method='PUT')
+        return code == 200
+
+    def _try_acquire(self, key=None):
+        key = key or self.key
+        params = self._query_params()
+        params['acquire'] = self.session
+        code, body, info = self._api_request(self._url('kv/%s' % key, params), data=self.value, method='PUT')
+        if code != 200:
+            self._fail("Failed acquiring %s with code %i and response %s" % (key, code, body))
+        return body == 'true'
+
+    def _blocking_get(self, path, params, index=0, deadline=None):
+        """GETs path, blocking until it changes past index or the wait
+        passes when an index is given, and returns the status code, body and
+        the new index"""
+        timeout = 10
+        if index:
+            wait = max(1, int(min(self._duration_seconds(self.wait), deadline - time.time())))
+            params['index'] = index
+            params['wait'] = '%ds' % wait
+            # Consul adds up to wait/16 of jitter to a blocking query
+            timeout = wait * 17 / 16 + 10
+        code, body, info = self._api_request(self._url(path, params), timeout=timeout)
+        new_index = int(info.get('x-consul-index') or 0)
+        # Reset when the index goes backwards, ie after a snapshot restore
+        return code, body, new_index if new_index >= index else 0
+
+    def _read_lock(self, index=0, deadline=None):
+        """Reads the key, blocking past index when one is given, and returns
+        the entry, if any, and the new index"""
+        code, body, new_index = self._blocking_get('kv/%s' % self.key, self._query_params(), index, deadline)
+        if code == 404:
+            return None, new_index
+        if code != 200:
+            self._fail("Failed reading %s with code %i and response %s" % (self.key, code, body))
+        return json.loads(body)[0], new_index
+
+    def _wait_for_release(self, index, deadline):
+        """Blocks until the key changes past index or the wait passes and
+        returns the holder's session, if any, and the new index"""
+        entry, index = self._read_lock(index or 1, deadline)
+        return (entry or {}).get('Session'), index
+
+    def _fail(self, msg, **kwargs):
+        # Do not leave sessions behind that nothing will release
+        if self.created_session:
+            self._destroy_session()
+        self.module.fail_json(msg=msg, **kwargs)
+
+    def _acquire(self):
+        """Acquires the lock, waiting on the key with blocking queries while
+        another session holds it instead of polling"""
+        if not self.session:
+            self._create_session()
+        if self.limit:
+            return self._acquire_semaphore()
+        deadline = time.time() + self.timeout
+        index, released = 0, None
+        while True:
+            if self._try_acquire():
+                self.module.exit_json(changed=True, succeeded=True, acquired=True, key=self.key, session=self.session)
+            if released is not None:
+                # A lock released by an invalidated session can not be acquired
+                # again until its lock delay passes. The key does not change
+                # when it does, so sleep instead of blocking on it.
+                until = min(released + self._duration_seconds(self.lock_delay), deadline)
+                time.sleep(max(0, until - time.time()))
+                index, released = 0, None
+            else:
+                holder, index = self._wait_for_release(index, deadline)
+                if not holder:
+                    released = time.time()
+            if time.time() >= deadline:
+                self._fail("Timed out after %is waiting for lock %s" % (self.timeout, self.key), key=self.key)
+
+    def _release(self):
+        if self.limit:
+            return self._release_semaphore()
+        params = self._query_params()
+        params['release'] = self.session
+        code, body, info = self._api_request(self._url('kv/%s' % self.key, params), method='PUT')
+        if code != 200:
+            self.module.fail_json(msg="Failed releasing %s with code %i and response %s" % (self.key, code, body))
+        released = body == 'true'
+        destroyed = self._destroy_session() if self.destroy_session else False
+        self.module.exit_json(changed=released or destroyed, succeeded=True, released=released, key=self.key,
+                              session=self.session, session_destroyed=destroyed)
+
+    def _contender_key(self):
+        return '%s/%s' % (self.key, self.session)
+
+    def _read_semaphore(self, index=0, deadline=None):
+        """Reads the semaphore prefix, blocking past index when one is given,
+        and returns the lock document, its ModifyIndex, the live contender
+        sessions and the new index"""
+        params = self._query_params()
+        params['recurse'] = ''
+        code, body, new_index = self._blocking_get('kv/%s/' % self.key, params, index, deadline)
+        if code == 404:
+            return {}, 0, set(), new_index
+        if code != 200:
+            self._fail("Failed reading semaphore %s with code %i and response %s" % (self.key, code, body))
+        lock_key = '%s/%s' % (self.key, self.SEMAPHORE_LOCK)
+        document, lock_index, live = {}, 0, set()
+        for entry in json.loads(body):
+            if entry['Key'] == lock_key:
+                document = json.loads(base64.b64decode(entry['Value'] or '') or '{}')
+                lock_index = entry['ModifyIndex']
+            elif entry.get('Session'):
+                live.add(entry['Session'])
+        return document, lock_index, live, new_index
+
+    def _write_semaphore(self, holders, lock_index):
+        params = self._query_params()
+        params['cas'] = lock_index
+        document = json.dumps({'Limit': self.limit, 'Holders': sorted(holders)})
+        url = self._url('kv/%s/%s' % (self.key, self.SEMAPHORE_LOCK), params)
+        code, body, info = self._api_request(url, data=document, method='PUT')
+        if code != 200:
+            self._fail("Failed updating semaphore %s with code %i and response %s" % (self.key, code, body))
+        return body == 'true'
+
+    def _delete_contender(self):
+        self._api_request(self._url('kv/%s' % self._contender_key()), method='DELETE')
+
+    def _fail_semaphore(self, msg, **kwargs):
+        self._delete_contender()
+        self._fail(msg, **kwargs)
+
+    def _acquire_semaphore(self):
+        """Registers a contender key and takes a slot in the lock document
+        when one is free. Holders whose sessions no longer hold a contender
+        key are pruned on every update. While the semaphore is full the
+        prefix is watched with blocking queries."""
+        if not self._try_acquire(self._contender_key()):
+            self._fail("Session %s could not hold contender key %s" % (self.session, self._contender_key()))
+        deadline = time.time() + self.timeout
+        index = 0
+        while True:
+            document, lock_index, live, index = self._read_semaphore(index, deadline)
+            if document and document.get('Limit') != self.limit:
+                self._fail_semaphore("Semaphore %s has limit %s, not %i" % (self.key, document.get('Limit'), self.limit))
+            holders = [holder for holder in document.get('Holders', []) if holder in live]
+            if self.session in holders:
+                self.module.exit_json(changed=False, succeeded=True, acquired=True, key=self.key,
+                                      session=self.session, holders=holders)
+            if len(holders) < self.limit:
+                holders.append(self.session)
+                if self._write_semaphore(holders, lock_index):
+                    self.module.exit_json(changed=True, succeeded=True, acquired=True, key=self.key,
+                                          session=self.session, holders=sorted(holders))
+                # Lost the check and set to another contender, read again
+                index = 0
+                continue
+            if time.time() >= deadline:
+                self._fail_semaphore("Timed out after %is waiting for semaphore %s" % (self.timeout, self.key),
+                                     key=self.key, holders=holders)
+
+    def _release_semaphore(self):
+        released = False
+        while True:
+            document, lock_index, live, index = self._read_semaphore()
+            holders = [holder for holder in document.get('Holders', []) if holder in live]
+            if self.session not in document.get('Holders', []) and holders == document.get('Holders', []):
+                break
+            released = released or self.session in document.get('Holders', [])
+            holders = [holder for holder in holders if holder != self.session]
+            if self._write_semaphore(holders, lock_index):
+                break
+        self._delete_contender()
+        destroyed = self._destroy_session() if self.destroy_session else False
+        self.module.exit_json(changed=released or destroyed, succeeded=True, released=released, key=self.key,
+                              session=self.session, session_destroyed=destroyed)
+
+    def _holder(self, entry):
+        """Returns the leader and its session from the key's entry"""
+        if not entry or not entry.get('Session'):
+            return None, None
+        return base64.b64decode(entry.get('Value') or ''), entry['Session']
+
+    def _node_name(self):
+        if self.node:
+            return self.node
+        code, body, info = self._api_request(self._url('agent/self'))
+        if code != 200:
+            self.module.fail_json(msg="Failed reading the agent with code %i and response %s" % (code, body))
+        return json.loads(body)['Config']['NodeName']
+
+    def _node_sessions(self):
+        """Returns the sessions of this node with the same name"""
+        code, body, info = self._api_request(self._url('session/node/%s' % self._node_name()))
+        if code != 200:
+            self.module.fail_json(msg="Failed listing sessions with code %i and response %s" % (code, body))
+        return set(session['ID'] for session in json.loads(body) or [] if session.get('Name') == self.name)
+
+    def _exit_election(self, is_leader, leader, leader_session, leader_changed=False, changed=None):
+        if not is_leader and self.created_session:
+            # Followers campaign again with a new session
+            self._destroy_session()
+            self.session = None
+        changed = is_leader if changed is None else changed
+        self.module.exit_json(changed=changed, succeeded=True, is_leader=is_leader, leader=leader,
+                              leader_session=leader_session, leader_changed=leader_changed, key=self.key,
+                              session=self.session)
+
+    def _elect(self):
+        """Campaigns with one acquire. Followers read the key once to learn
+        the leader and, with wait_for_change, block on it until the leader
+        changes instead of polling"""
+        if not self.session:
+            # Candidates sharing an agent share the node and session name,
+            # so only the one whose value is held keeps the session
+            leader, leader_session = self._holder(self._read_lock()[0])
+            if leader_session and leader == self.value and leader_session in self._node_sessions():
+                self.session = leader_session
+                self._exit_election(True, self.value, self.session, changed=False)
+            self._create_session()
+        if self._try_acquire():
+            self._exit_election(True, self.value, self.session)
+        entry, index = self._read_lock()
+        leader, leader_session = self._holder(entry)
+        if not self.wait_for_change:
+            self._exit_election(False, leader, leader_session)
+        watched = leader_session
+        deadline = time.time() + self.timeout
+        while time.time() < deadline:
+            entry, index = self._read_lock(index or 1, deadline)
+            leader, leader_session = self._holder(entry)
+            if leader_session and leader_session == watched:
+                continue
+            if leader_session:
+                self._exit_election(False, leader, leader_session, True)
+            # Nobody leads, campaign again. Within the lock delay of the old
+            # leader's session this fails and is retried after the next wait
+            if self._try_acquire():
+                self._exit_election(True, self.value, self.session, True)
+        self._exit_election(False, leader, leader_session)
+
+
+def main():
+    global module
+    module = AnsibleModule(
+        argument_spec=dict(
+            action=dict(required=True),
+            behavior=dict(required=False, default='release'),
+            checks=dict(required=False, default=ConsulLock.DEFAULT_CHECKS[0]),
+            dc=dict(required=False, default='dc1'),
+            destroy_session=dict(required=False, default=True, type='bool'),
+            host=dict(required=False, default='127.0.0.1'),
+            key=dict(required=True),
+            limit=dict(required=False, type='int'),
+            lock_delay=dict(required=False, default='15s'),
+            name=dict(required=False),
+            node=dict(required=False),
+            port=dict(required=False, default=8500),
+            session=dict(required=False),
+            timeout=dict(required=False, default=300, type='int'),
+            token=dict(required=False, default=None),
+            ttl=dict(required=False),
+            value=dict(required=False),
+            version=dict(required=False, default='v1'),
+            wait=dict(required=False, default='30s'),
+            wait_for_change=dict(required=False, default=False, type='bool'),
+        ),
+        supports_check_mode=True
+    )
+
+    # If we're in check mode, just exit pretending like we succeeded
+    if module.check_mode:
+        module.exit_json(changed=False)
+
+    consul_lock = ConsulLock(module)
+    consul_lock.run_cmd()
+
+
+# import module snippets
+from ansible.module_utils.basic import *
+from ansible.module_utils.urls import *
+
+if __name__ == '__main__':
+    main()
@@ -18,11 +18,20 @@
 # You should have received a copy of the GNU General Public License
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
+import fnmatch
+import heapq
+import httplib
 import json
+import os
+import random
+import re
+import socket
 import string
+import time
 import urllib
 
 from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 
 DOCUMENTATION = '''
@@ -33,10 +42,15 @@ author: Chavez
 short_description: Interact with Consul Sessions API
 description:
    - Use Consul Sessions API in your playbooks and roles
+   - keepalive renews the sessions once and leaves a detached process
+     renewing them at half their TTL, with jitter, over one connection until
+     they are destroyed or duration passes
+   - cleanup lists sessions once and destroys the ones matching every given
+     filter of node, name, match_checks and max_create_index concurrently
 options:
   action:
     description:
-      - API session action [create, destroy, info, node, list, renew]
+      - API session action [create, destroy, info, node, list, renew, keepalive, cleanup]
     required: true
   behavior:
     description:
@@ -46,11 +60,27 @@ options:
     description:
       - List of associated health checks comma separated "foo,bar,baz"
     required: false
+  concurrency:
+    description:
+      - Number of sessions destroyed at once on cleanup
+    required: false
+    default: 8
+  consistency:
+    description:
+      - Consistency mode for reads [default, stale, consistent]. stale lets
+        any server answer the read instead of the leader.
+    required: false
+    default: default
   dc:
     desription:
       - The datacenter to use
     required: false
     default: dc1
+  duration:
+    description:
+      - How long the keepalive process renews sessions before exiting, ie 2h
+    required: false
+    default: 1h
   host:
     description:
       - Consul host
@@ -60,9 +90,33 @@ options:
     description:
       - Time to delay the lock of the session
     require: false
+  lock_prefix:
+    description:
+      - K/V prefix read on cleanup to report the keys released by the
+        destroyed sessions
+    required: false
+  match_checks:
+    description:
+      - Cleanup only sessions that have all of these health checks, comma
+        separated "foo,bar"
+    required: false
+  max_create_index:
+    description:
+      - Cleanup only sessions with a CreateIndex at or below this index
+    required: false
+  max_stale:
+    description:
+      - With stale consistency, fail when the answering server last heard
+        from the leader longer ago than this duration, ie 5s
+    required: false
+  name:
+    description:
+      - Session name to set on create. On cleanup a glob pattern sessions
+        names must match, ie "deploy-*"
+    required: false
   node:
     description:
-      - Node name to set on create
+      - Node name to set on create and to match on cleanup
     required: false
   port:
     description:
@@ -70,7 +124,8 @@ options:
     required: true
   session:
     description:
-      - Consul session to interact with
+      - Consul session to interact with, comma separated "foo,bar" to keep
+        several alive
     require: false
   token:
     description:
@@ -111,6 +166,12 @@ EXAMPLES = '''
 
 # All sessions for a node
 - consul_session: action=node node="node-foo"
+
+# Keep sessions alive for the rest of the play
+- consul_session: action=keepalive session="session-foo,session-bar" duration=2h
+
+# Destroy orphaned deploy sessions of a node and report the locks they held
+- consul_session: action=cleanup node="node-foo" name="deploy-*" lock_prefix="locks/"
 '''
 
 #
@@ -120,23 +181,34 @@ EXAMPLES = '''
 
 class ConsulSession(object):
 
-    ALLOWED_ACTIONS = ['create', 'destroy', 'info', 'node', 'list', 'renew']
-    CREATE, DESTROY, INFO, NODE, LIST, RENEW = ALLOWED_ACTIONS
+    ALLOWED_ACTIONS = ['create', 'destroy', 'info', 'node', 'list', 'renew', 'keepalive', 'cleanup']
+    CREATE, DESTROY, INFO, NODE, LIST, RENEW, KEEPALIVE, CLEANUP = ALLOWED_ACTIONS
 
     PUT_ACTIONS = [CREATE, DESTROY, RENEW]
     GET_ACTIONS = [INFO, NODE, LIST]
 
     DEFAULT_CHECKS = ['serfHealth']
 
+    CONSISTENCY_MODES = ['default', 'stale', 'consistent']
+    DEFAULT, STALE, CONSISTENT = CONSISTENCY_MODES
+
     def __init__(self, module):
         """Takes an AnsibleModule object to set up Consul Session interaction"""
         self.module = module
         self.action = string.lower(module.params.get('action', ''))
         self.behavior = module.params.get('behavior', 'release')
         self.checks = module.params.get('checks', self.DEFAULT_CHECKS[0])
+        self.concurrency = module.params.get('concurrency', 8)
+        self.consistency = module.params.get('consistency', self.DEFAULT)
         self.dc = module.params.get('dc', 'dc1')
+        self.duration = module.params.get('duration', '1h')
         self.host = module.params.get('host', '127.0.0.1')
         self.lock_delay = module.params.get('lock_delay', '15s')
+        self.lock_prefix = module.params.get('lock_prefix', None)
+        self.match_checks = module.params.get('match_checks', None) or []
+        self.max_create_index = module.params.get('max_create_index', None)
+        self.max_stale = module.params.get('max_stale', None)
+        self.name = module.params.get('name', None)
         self.node = module.params.get('node', '')
         self.port = module.params.get('port', 8500)
         self.session = module.params.get('session', '')
@@ -150,6 +222,10 @@ class ConsulSession(object):
 
     def run_cmd(self):
         self.validate()
+        if self.action == self.KEEPALIVE:
+            return self._keepalive()
+        if self.action == self.CLEANUP:
+            return self._cleanup()
         self._make_api_call()
 
     def validate(self):
@@ -158,7 +234,7 @@ class ConsulSession(object):
             self.module.fail_json(msg='Action is required and must be one of %r' % self.ALLOWED_ACTIONS)
         # Validate action being used
         # ie self._validate_create(), self._validate_destroy(), self._validate_info()
-        getattr(self, "_validate_%s" % self.action)
+        getattr(self, "_validate_%s" % self.action)()
 
     def _build_url(self):
         self.api_url = "http://%s:%s/%s/session/%s" % (self.host, self.port, self.version, self.action)
@@ -182,6 +258,14 @@ class ConsulSession(object):
         if not self.session:
             module.fail_json(msg="Renew requires a session")
 
+    def _validate_keepalive(self):
+        if not self.session:
+            module.fail_json(msg="Keepalive requires a session")
+
+    def _validate_cleanup(self):
+        if not (self.node or self.name or self.match_checks or self.max_create_index is not None):
+            module.fail_json(msg="Cleanup requires at least one of node, name, match_checks or max_create_index")
+
     def _validate_node(self):
         pass
 
@@ -195,6 +279,7 @@ class ConsulSession(object):
             (response, info) = fetch_url(module, self.api_url, data=self.req_data, method=self._http_verb_for_action())
         except Exception, e:
             self.module.fail_json(msg="API call ({}) failed: {}".format(self.api_url, str(e)))
+        self.info = info
 
         try:
             response_body = response.read()
@@ -238,8 +323,214 @@ class ConsulSession(object):
             params['dc'] = self.dc
         if self.token:
             params['token'] = self.token
+        if self.action in self.GET_ACTIONS:
+            self._consistency_params(params)
         return params
 
+    def _duration_seconds(self, duration):
+        """Converts a Consul duration like 500ms, 30s or 1m30s to seconds,
+        a bare number is taken as seconds"""
+        units = {'ns': 1e-9, 'us': 1e-6, 'ms': 1e-3, 's': 1, 'm': 60, 'h': 3600}
+        duration = str(duration).strip()
+        if re.match(r'^\d+(?:\.\d+)?$', duration):
+            return float(duration)
+        if not re.match(r'^(?:\d+(?:\.\d+)?(?:ns|us|ms|s|m|h))+$', duration):
+            self.module.fail_json(msg='Invalid duration %s' % duration)
+        return sum(float(number) * units[unit]
+                   for number, unit in re.findall(r'(\d+(?:\.\d+)?)(ns|us|ms|s|m|h)', duration))
+
+    def _consistency_params(self, params):
+        if self.consistency in [self.STALE, self.CONSISTENT]:
+            params[self.consistency] = ''
+            if self.consistency == self.STALE and self.max_stale:
+                params['max_stale'] = self.max_stale
+        return params
+
+    def _read_metadata(self, info):
+        """Returns the staleness headers of a read, failing when the server
+        answering lost contact with the leader longer than max_stale ago"""
+        last_contact = info.get('x-consul-lastcontact')
+        last_contact = int(last_contact) if last_contact is not None else None
+        known_leader = info.get('x-consul-knownleader')
+        known_leader = known_leader == 'true' if known_leader is not None else None
+        if self.max_stale and last_contact is not None:
+            if last_contact > self._duration_seconds(self.max_stale) * 1000:
+                self.module.fail_json(msg="Read is %ims stale which is more than max_stale %s" % (last_contact, self.max_stale),
+                                      last_contact=last_contact, known_leader=known_leader)
+        return dict(last_contact=last_contact, known_leader=known_leader)
+
+    def _renew(self, connection, session):
+        """Renews a session over a reused connection, returning the status
+        code and body or -1 when the connection failed"""
+        path = "/%s/session/renew/%s" % (self.version, session)
+        params = urllib.urlencode(self._query_params())
+        if params:
+            path = path + '?' + params
+        try:
+            connection.request('PUT', path, '')
+            response = connection.getresponse()
+            return response.status, response.read()
+        except (httplib.HTTPException, socket.error), e:
+            # The next request opens a new connection
+            connection.close()
+            return -1, str(e)
+
+    def _session_ttl(self, body, default=0):
+        try:
+            return self._duration_seconds(json.loads(body)[0].get('TTL') or '0s') or default
+        except (ValueError, IndexError, TypeError, AttributeError):
+            return default
+
+    def _renew_interval(self, ttl):
+        return ttl / 2.0 * random.uniform(0.9, 1.1)
+
+    def _keepalive(self):
+        """Renews every session once to check it exists and learn its TTL,
+        then forks the detached renewer"""
+        sessions = filter(None, [session.strip() for session in str(self.session or '').split(',')])
+        if not sessions:
+            self.module.fail_json(msg="Keepalive requires a session")
+        deadline = time.time() + self._duration_seconds(self.duration)
+        connection = httplib.HTTPConnection(self.host, int(self.port), timeout=10)
+        ttls = OrderedDict({})
+        for session in sessions:
+            code, body = self._renew(connection, session)
+            if code != 200:
+                self.module.fail_json(msg="Failed renewing session %s with code %i and response %s" % (session, code, body))
+            ttls[session] = self._session_ttl(body)
+        connection.close()
+        without_ttl = [session for session, ttl in ttls.iteritems() if not ttl]
+        if without_ttl:
+            self.module.fail_json(msg="Sessions without a TTL do not need a keepalive: %s" % ', '.join(without_ttl))
+        pid = self._spawn_renewer(ttls, deadline)
+        self.module.exit_json(changed=True, succeeded=True, pid=pid, sessions=sessions, deadline=int(deadline))
+
+    def _spawn_renewer(self, ttls, deadline):
+        """Double forks so the renewer outlives the module and is not left
+        as a zombie, returning the renewer's pid"""
+        read_fd, write_fd = os.pipe()
+        pid = os.fork()
+        if pid:
+            os.close(write_fd)
+            os.waitpid(pid, 0)
+            renewer = os.read(read_fd, 32)
+            os.close(read_fd)
+            # Nothing is written when the renewer died before starting
+            if not renewer:
+                self.module.fail_json(msg="The session renewer exited before it started")
+            return int(renewer)
+        try:
+            os.close(read_fd)
+            os.setsid()
+            if os.fork():
+                os._exit(0)
+            os.write(write_fd, str(os.getpid()))
+            os.close(write_fd)
+            # Ansible waits for the module's output to close
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in (0, 1, 2):
+                os.dup2(devnull, fd)
+            self._renew_until(ttls, deadline)
+        finally:
+            os._exit(0)
+
+    def _renew_until(self, ttls, deadline):
+        """Renews each session at half its TTL until it is destroyed or the
+        deadline passes"""
+        connection = httplib.HTTPConnection(self.host, int(self.port), timeout=10)
+        schedule = [(time.time() + self._renew_interval(ttl), session) for session, ttl in ttls.iteritems()]
+        heapq.heapify(schedule)
+        while schedule:
+            renew_at, session = schedule[0]
+            if renew_at >= deadline:
+                break
+            time.sleep(max(0, renew_at - time.time()))
+            heapq.heappop(schedule)
+            code, body = self._renew(connection, session)
+            if code == 404:
+                # Destroyed or already expired
+                continue
+            ttls[session] = self._session_ttl(body, ttls[session])
+            interval = self._renew_interval(ttls[session])
+            if code != 200:
+                interval = min(interval, 1)
+            heapq.heappush(schedule, (time.time() + interval, session))
+        connection.close()
+
+    def _url(self, path, params=None):
+        url = "http://%s:%s/%s/%s" % (self.host, self.port, self.version, path)
+        params = urllib.urlencode(params if params is not None else self._query_params())
+        if params:
+            url = url + '?' + params
+        return url
+
+    def _api_request(self, url, data=None, method='GET'):
+        """Makes a request and returns the status code and body"""
+        (response, info) = fetch_url(self.module, url, data=data, method=method)
+        if response is None:
+            return info.get('status', -1), info.get('body', info.get('msg', ''))
+        return response.getcode(), response.read()
+
+    def _cleanup_matches(self, session):
+        if self.node and session.get('Node') != self.node:
+            return False
+        if self.name and not fnmatch.fnmatchcase(session.get('Name') or '', self.name):
+            return False
+        if self.match_checks and not set(self.match_checks) <= set(session.get('Checks') or []):
+            return False
+        if self.max_create_index is not None and session.get('CreateIndex', 0) > self.max_create_index:
+            return False
+        return True
+
+    def _held_keys(self):
+        """Maps each session holding a key under lock_prefix to its keys"""
+        held = {}
+        if not self.lock_prefix:
+            return held
+        params = self._query_params()
+        params['recurse'] = ''
+        code, body = self._api_request(self._url('kv/%s' % self.lock_prefix, params))
+        if code == 404:
+            return held
+        if code != 200:
+            self.module.fail_json(msg="Failed reading %s with code %i and response %s" % (self.lock_prefix, code, body))
+        for entry in json.loads(body):
+            if entry.get('Session'):
+                held.setdefault(entry['Session'], []).append(entry['Key'])
+        return held
+
+    def _destroy(self, session):
+        code, body = self._api_request(self._url('session/destroy/%s' % session), method='PUT')
+        return session, code == 200, body
+
+    def _cleanup(self):
+        """Lists sessions once, from the node's sessions when a node is
+        given, and destroys the matches with a bounded pool of workers"""
+        path = 'session/node/%s' % self.node if self.node else 'session/list'
+        code, body = self._api_request(self._url(path))
+        if code != 200:
+            self.module.fail_json(msg="Failed listing sessions with code %i and response %s" % (code, body))
+        matches = [session['ID'] for session in json.loads(body) or [] if self._cleanup_matches(session)]
+        held = self._held_keys()
+        destroyed, failed = [], {}
+        if matches:
+            pool = ThreadPool(max(1, min(self.concurrency, len(matches))))
+            try:
+                results = pool.map(self._destroy, matches)
+            finally:
+                pool.close()
+            for session, ok, response in results:
+                if ok:
+                    destroyed.append(session)
+                else:
+                    failed[session] = response
+        released = sorted(key for session in destroyed for key in held.get(session, []))
+        result = dict(changed=bool(destroyed), destroyed=destroyed, released_keys=released)
+        if failed:
+            self.module.fail_json(msg="Failed destroying %i of %i sessions" % (len(failed), len(matches)),
+                                  failed_sessions=failed, **result)
+        self.module.exit_json(succeeded=True, **result)
+
     def _http_verb_for_action(self):
         if self.action in self.PUT_ACTIONS:
             return 'PUT'
@@ -254,7 +545,10 @@ class ConsulSession(object):
                 parsed_response = json.loads(response_body)
             except:
                 parsed_response = ''
-            self.module.exit_json(changed=True, succeeded=True, value=parsed_response)
+            result = dict(changed=True, succeeded=True, value=parsed_response)
+            if self.action in self.GET_ACTIONS:
+                result.update(self._read_metadata(self.info))
+            self.module.exit_json(**result)
 
 
 def main():
@@ -264,9 +558,17 @@ def main():
             action=dict(required=True),
             behavior=dict(required=False, default='release'),
             checks=dict(required=False, default=ConsulSession.DEFAULT_CHECKS[0]),
+            concurrency=dict(required=False, default=8, type='int'),
+            consistency=dict(required=False, default='default', choices=['default', 'stale', 'consistent']),
             dc=dict(required=False, default='dc1'),
+            duration=dict(required=False, default='1h'),
             host=dict(required=False, default='127.0.0.1'),
             lock_delay=dict(require=False, default='15s'),
+            lock_prefix=dict(required=False),
+            match_checks=dict(required=False, type='list'),
+            max_create_index=dict(required=False, type='int'),
+            max_stale=dict(required=False),
+            name=dict(required=False),
             node=dict(required=False),
             port=dict(require=False, default=8500),
             session=dict(require=False),
@@ -0,0 +1,221 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2015 Chavez <chavez@somewhere-cool.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Lookup Consul ACLs on the controller.
+
+Each term is an ACL ID, or a name with by=name, and returns the ACL as
+acl/info would. The term * returns every ACL as acl/list would. IDs are read
+with acl/info, which works with any token, while names and * list the ACLs
+with acl/list, which needs a management token.
+
+ACLs read are cached by datacenter, token and ID in files shared by every
+host and play in the run, as each lookup runs in a forked worker. Once ttl
+seconds pass the cache is validated against the current X-Consul-Index of
+the ACL table and dropped when it changed. ACL IDs are tokens so the files
+are only readable by the controller user. At most cache_size datacenter and
+token pairs are kept, the least recently used file is removed first.
+
+Options: host, port, dc, token, version, by, ttl, default, cache_size,
+cache_dir
+
+  deploy_acl: "{{ lookup('consul_acl', 'deploy', by='name', token=master_token) }}"
+  acl_rules: "{{ lookup('consul_acl', acl_id, token=deploy_token).Rules }}"
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+import time
+import urllib
+
+from collections import OrderedDict
+
+from ansible.errors import AnsibleError
+from ansible.module_utils.urls import open_url
+from ansible.plugins.lookup import LookupBase
+
+DEFAULTS = {
+    'host': '127.0.0.1',
+    'port': 8500,
+    'dc': 'dc1',
+    'token': None,
+    'version': 'v1',
+    'by': 'id',
+    'ttl': 60,
+    'cache_size': 16,
+    'cache_dir': os.path.expanduser('~/.ansible/tmp/consul_acl_lookup'),
+}
+
+LOOKUP_FIELDS = {'id': 'ID', 'name': 'Name'}
+ALL_ACLS = '*'
+
+
+class ConsulACLCache(object):
+
+    def __init__(self, options):
+        self.host = options['host']
+        self.port = options['port']
+        self.dc = options['dc']
+        self.token = options['token']
+        self.version = options['version']
+        self.ttl = int(options['ttl'])
+        self.cache_size = max(1, int(options['cache_size']))
+        self.cache_dir = options['cache_dir']
+        self.index = None
+        self.checked = 0
+        self.acls = {}
+        self.listed = None
+        self.dirty = False
+
+    def _query_params(self):
+        params = OrderedDict({})
+        if self.dc != 'dc1':
+            params['dc'] = self.dc
+        if self.token:
+            params['token'] = self.token
+        return params
+
+    def _url(self, path):
+        url = "http://%s:%s/%s/acl/%s" % (self.host, self.port, self.version, path)
+        params = urllib.urlencode(self._query_params())
+        if params:
+            url = url + '?' + params
+        return url
+
+    def _get(self, path):
+        """Returns the parsed body and X-Consul-Index"""
+        try:
+            response = open_url(self._url(path))
+            return json.loads(response.read()), int(response.info().get('X-Consul-Index') or 0)
+        except Exception, e:
+            raise AnsibleError("Consul ACL lookup of %s failed: %s" % (path, str(e)))
+
+    def _cache_path(self):
+        name = hashlib.sha1(json.dumps([self.host, self.port, self.dc, self.token])).hexdigest()
+        return os.path.join(self.cache_dir, name + '.json')
+
+    def _load(self):
+        try:
+            with open(self._cache_path()) as cached:
+                data = json.load(cached)
+        except (IOError, ValueError):
+            return
+        self.index, self.checked = data['index'], data['checked']
+        self.acls, self.listed = data['acls'], data['listed']
+        # Mark the file as recently used for the eviction in _prune
+        os.utime(self._cache_path(), None)
+
+    def _save(self):
+        # ACL IDs are tokens, keep them readable by the controller user only
+        tmp_path = self._cache_path() + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as cached:
+            json.dump(dict(index=self.index, checked=self.checked, acls=self.acls, listed=self.listed), cached)
+        os.rename(tmp_path, self._cache_path())
+        self._prune()
+
+    def _prune(self):
+        """Removes the least recently used cache files over cache_size"""
+        paths = [os.path.join(self.cache_dir, name) for name in os.listdir(self.cache_dir) if name.endswith('.json')]
+        paths.sort(key=lambda path: os.path.getmtime(path), reverse=True)
+        for path in paths[self.cache_size:]:
+            for stale in (path, path + '.lock'):
+                try:
+                    os.remove(stale)
+                except OSError:
+                    pass
+
+    def _read(self, path):
+        """Reads from Consul, keeping the ACL table index of the first read
+        so a new cache is validated without an extra request"""
+        body, index = self._get(path)
+        if self.index is None:
+            self.index, self.checked = index, time.time()
+        self.dirty = True
+        return body
+
+    def _refresh(self):
+        """Drops the cached ACLs when ttl passed and the ACL table changed
+        since they were read"""
+        if self.index is None or time.time() - self.checked < self.ttl:
+            return
+        # Every ACL read returns the index of the whole ACL table, reading
+        # the anonymous ACL is the cheapest one
+        body, index = self._get('info/anonymous')
+        if index != self.index:
+            self.acls, self.listed = {}, None
+            self.index = index
+        self.checked = time.time()
+        self.dirty = True
+
+    def info(self, acl_id):
+        """Returns the ACL with the ID, or None when it does not exist"""
+        if acl_id not in self.acls:
+            body = self._read('info/%s' % urllib.quote(acl_id, ''))
+            self.acls[acl_id] = body[0] if body else None
+        return self.acls[acl_id]
+
+    def list(self):
+        if self.listed is None:
+            self.listed = self._read('list') or []
+        return self.listed
+
+    def find(self, value, by):
+        if by == 'id':
+            return self.info(value)
+        field = LOOKUP_FIELDS[by]
+        for acl in self.list():
+            if acl.get(field) == value:
+                return acl
+        return None
+
+    def lookup(self, terms, by):
+        """Returns the ACL, or None, for each term, holding a lock on the
+        cache so hosts looking up ACLs at once only read them one time"""
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, 0700)
+        fd = os.open(self._cache_path() + '.lock', os.O_WRONLY | os.O_CREAT, 0600)
+        with os.fdopen(fd, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._load()
+            self._refresh()
+            acls = [self.list() if term == ALL_ACLS else self.find(term, by) for term in terms]
+            if self.dirty:
+                self._save()
+        return acls
+
+
+class LookupModule(LookupBase):
+
+    def run(self, terms, variables=None, **kwargs):
+        options = dict(DEFAULTS)
+        options.update((k, v) for k, v in kwargs.iteritems() if k in DEFAULTS)
+        if options['by'] not in LOOKUP_FIELDS:
+            raise AnsibleError("by must be one of %r" % sorted(LOOKUP_FIELDS))
+        values = []
+        for term, acl in zip(terms, ConsulACLCache(options).lookup(terms, options['by'])):
+            if acl is not None:
+                values.append(acl)
+            elif 'default' in kwargs:
+                values.append(kwargs['default'])
+            else:
+                raise AnsibleError("ACL %s does not exist in Consul" % term)
+        return values
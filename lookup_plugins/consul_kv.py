@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+# Copyright 2015 Chavez <chavez@somewhere-cool.com>
+#
+# This file is part of Ansible
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Lookup Consul K/V values on the controller.
+
+Each term is a key. The prefix holding the key, its parent path by default,
+is read with a single recursive GET and kept in a cache shared by every
+host and play in the run, so templates referencing many keys under the same
+prefix cost one request. A top level key without a prefix is read on its
+own. Once ttl seconds pass the cached prefix is validated against the
+current X-Consul-Index with a cheap keys listing and only read again when it
+changed. Cache files are only readable by the controller user. Values compressed or sharded by the
+consul_kv module are returned decompressed.
+
+Options: host, port, dc, token, version, prefix, ttl, default, cache_dir
+
+  db_host: "{{ lookup('consul_kv', 'app/config/db/host') }}"
+  db_port: "{{ lookup('consul_kv', 'app/config/db/port', prefix='app/config/') }}"
+  flag: "{{ lookup('consul_kv', 'app/flags/new_ui', default='false', ttl=300) }}"
+"""
+
+import base64
+import fcntl
+import hashlib
+import json
+import os
+import time
+import urllib
+import zlib
+
+from collections import OrderedDict
+
+from ansible.errors import AnsibleError
+from ansible.module_utils.urls import open_url
+from ansible.plugins.lookup import LookupBase
+
+DEFAULTS = {
+    'host': '127.0.0.1',
+    'port': 8500,
+    'dc': 'dc1',
+    'token': None,
+    'version': 'v1',
+    'prefix': None,
+    'ttl': 60,
+    'cache_dir': os.path.expanduser('~/.ansible/tmp/consul_kv_lookup'),
+}
+
+# Flags the consul_kv module marks compressed and sharded values with
+COMPRESSED_FLAG = 1 << 62
+MANIFEST_FLAG = 1 << 61
+CHUNK_FLAG = 1 << 60
+CHUNK_SUFFIX = '.chunks/'
+
+# Prefixes already read by this process, workers forked for each task also
+# share them through the cache files in cache_dir
+_PREFIXES = {}
+
+
+class ConsulKVPrefix(object):
+
+    def __init__(self, prefix, options, recurse=True):
+        self.prefix = prefix
+        self.recurse = recurse
+        self.host = options['host']
+        self.port = options['port']
+        self.dc = options['dc']
+        self.token = options['token']
+        self.version = options['version']
+        self.ttl = int(options['ttl'])
+        self.cache_dir = options['cache_dir']
+        self.index = None
+        self.fetched = 0
+        self.entries = {}
+
+    def _query_params(self, **extra):
+        params = OrderedDict({})
+        if self.dc != 'dc1':
+            params['dc'] = self.dc
+        if self.token:
+            params['token'] = self.token
+        params.update(extra)
+        return params
+
+    def _url(self, path, params):
+        url = "http://%s:%s/%s/kv/%s" % (self.host, self.port, self.version, path)
+        params = urllib.urlencode(params)
+        if params:
+            url = url + '?' + params
+        return url
+
+    def _get(self, path, params):
+        """Returns the parsed body and X-Consul-Index, a missing path is
+        returned as no entries"""
+        try:
+            response = open_url(self._url(path, params))
+            return json.loads(response.read()), int(response.info().get('X-Consul-Index') or 0)
+        except Exception, e:
+            if getattr(e, 'code', None) == 404:
+                return [], int(e.info().get('X-Consul-Index') or 0)
+            raise AnsibleError("Consul lookup of %s failed: %s" % (path, str(e)))
+
+    def _assemble(self, key, manifest, values):
+        """Returns the decompressed value of a sharded key, reading its
+        chunks when they were not read along with it"""
+        manifest = json.loads(manifest)
+        chunk_prefix = '%s%s%s/' % (key, CHUNK_SUFFIX, manifest['generation'])
+        names = [chunk_prefix + '%06d' % n for n in range(manifest['chunks'])]
+        if not all(name in values for name in names):
+            body, index = self._get(chunk_prefix, self._query_params(recurse='true'))
+            values = dict((obj['Key'], base64.b64decode(obj.get('Value') or '')) for obj in body)
+        if not all(name in values for name in names):
+            raise AnsibleError("Consul lookup of %s failed: missing chunks under %s" % (key, chunk_prefix))
+        return zlib.decompress(''.join(values[name] for name in names))
+
+    def _decode(self, body):
+        """Returns the values of raw entries by key, decompressing
+        compressed values and assembling sharded ones from their chunks"""
+        values = dict((obj['Key'], base64.b64decode(obj.get('Value') or '')) for obj in body)
+        entries = {}
+        for obj in body:
+            key, flags = obj['Key'], obj.get('Flags', 0)
+            if flags & CHUNK_FLAG:
+                continue
+            if flags & MANIFEST_FLAG:
+                entries[key] = self._assemble(key, values[key], values)
+            elif flags & COMPRESSED_FLAG:
+                entries[key] = zlib.decompress(values[key])
+            else:
+                entries[key] = values[key]
+        return entries
+
+    def _cache_path(self):
+        name = hashlib.sha1(json.dumps([self.host, self.port, self.dc, self.token, self.prefix, self.recurse])).hexdigest()
+        return os.path.join(self.cache_dir, name + '.json')
+
+    def _load(self):
+        try:
+            with open(self._cache_path()) as cached:
+                data = json.load(cached)
+        except (IOError, ValueError):
+            return
+        self.index, self.fetched, self.entries = data['index'], data['fetched'], data['entries']
+
+    def _save(self):
+        tmp_path = self._cache_path() + '.tmp'
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0600)
+        with os.fdopen(fd, 'w') as cached:
+            json.dump(dict(index=self.index, fetched=self.fetched, entries=self.entries), cached)
+        os.rename(tmp_path, self._cache_path())
+
+    def _fetch(self):
+        params = self._query_params(recurse='true') if self.recurse else self._query_params()
+        body, self.index = self._get(self.prefix, params)
+        self.entries = self._decode(body)
+        self.fetched = time.time()
+
+    def _current_index(self):
+        # Listing one level of keys returns the same index as the full
+        # recursive read without transferring the values
+        body, index = self._get(self.prefix, self._query_params(keys='true', separator='/'))
+        return index
+
+    def refresh(self):
+        """Makes sure the entries are fresh, holding a lock on the cache so
+        hosts looking up the same prefix at once only read it one time"""
+        if self.fetched and time.time() - self.fetched < self.ttl:
+            return
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, 0700)
+        fd = os.open(self._cache_path() + '.lock', os.O_WRONLY | os.O_CREAT, 0600)
+        with os.fdopen(fd, 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._load()
+            if self.fetched and time.time() - self.fetched < self.ttl:
+                return
+            # A single key is read again as listing it costs about the same
+            if self.fetched and self.recurse and self._current_index() == self.index:
+                self.fetched = time.time()
+            else:
+                self._fetch()
+            self._save()
+
+
+class LookupModule(LookupBase):
+
+    def run(self, terms, variables=None, **kwargs):
+        options = dict(DEFAULTS)
+        options.update((k, v) for k, v in kwargs.iteritems() if k in DEFAULTS)
+        values = []
+        for key in terms:
+            prefix, recurse = options['prefix'], True
+            if prefix is None and '/' not in key:
+                # Reading the root prefix would pull the whole store
+                prefix, recurse = key, False
+            elif prefix is None:
+                prefix = key.rpartition('/')[0] + '/'
+            if not key.startswith(prefix):
+                raise AnsibleError("Key %s is not under prefix %s" % (key, prefix))
+            cache_key = (options['host'], options['port'], options['dc'], options['token'], prefix, recurse)
+            if cache_key not in _PREFIXES:
+                _PREFIXES[cache_key] = ConsulKVPrefix(prefix, options, recurse)
+            consul_prefix = _PREFIXES[cache_key]
+            consul_prefix.ttl = int(options['ttl'])
+            consul_prefix.refresh()
+            if key in consul_prefix.entries:
+                values.append(consul_prefix.entries[key])
+            elif 'default' in kwargs:
+                values.append(kwargs['default'])
+            else:
+                raise AnsibleError("Key %s does not exist in Consul" % key)
+        return values